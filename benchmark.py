@@ -0,0 +1,484 @@
+import argparse
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import timeit
+from datetime import date, timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Final
+
+import numpy as np
+import pandas as pd
+
+import release_store
+import update_consumer_stats
+import update_dataset
+import utils
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from collections.abc import Callable, Generator
+
+_LOGGER = logging.getLogger(__name__)
+
+END_DATE: Final[date] = date(2025, 6, 30)
+
+# (packages, rows per consumer data day), production is about the size of the live data
+SCALES: Final[dict[str, tuple[int, int]]] = {
+    "production": (25000, 170000),
+    "smoke": (3000, 25000),
+}
+
+# weights loosely follow the share of rows observed in the BigQuery exports
+CPU_WEIGHTS: Final[dict[str, float]] = {
+    "x86_64": 22790,
+    "aarch64": 3403,
+    "armv7l": 28,
+    "s390x": 16,
+    "ppc64le": 12,
+    "i686": 31,
+}
+PYTHON_WEIGHTS: Final[dict[str, float]] = {
+    "3.10": 4203,
+    "3.11": 4061,
+    "3.9": 3957,
+    "3.7": 2528,
+    "3.12": 3451,
+    "3.8": 3220,
+    "3.13": 1931,
+    "3.6": 1405,
+    "2.7": 1118,
+    "3.5": 319,
+    "3.14": 44,
+    "3.4": 42,
+    "3.15": 1,
+}
+GLIBC_WEIGHTS: Final[dict[str, float]] = {
+    "2.35": 3837,
+    "2.31": 4149,
+    "2.36": 3167,
+    "2.39": 4034,
+    "2.26": 1121,
+    "2.27": 1169,
+    "2.34": 1443,
+    "2.28": 2030,
+    "2.17": 907,
+    "2.41": 1370,
+    "2.40": 990,
+    "2.23": 482,
+    "2.24": 357,
+    "2.38": 450,
+    "2.37": 164,
+    "2.19": 142,
+    "2.32": 145,
+    "2.2": 37,
+    "2.7": 21,
+    "2.33": 99,
+    "2.12": 28,
+    "2.22": 34,
+    "2.29": 33,
+    "2.30": 17,
+}
+MANYLINUX_TAGS: Final[tuple[str, ...]] = (
+    "manylinux1_x86_64",
+    "manylinux2010_x86_64",
+    "manylinux2014_x86_64.manylinux_2_17_x86_64",
+    "manylinux_2_28_x86_64",
+    "manylinux_2_34_x86_64",
+)
+
+
+def _choice(rng: np.random.Generator, weights: dict[str, float], size: int) -> np.ndarray:
+    p = np.array(list(weights.values()))
+    return rng.choice(np.array(list(weights), dtype=object), size=size, p=p / p.sum())
+
+
+def _generate_consumer_day(
+    rng: np.random.Generator,
+    projects: np.ndarray,
+    rows: int,
+) -> pd.DataFrame:
+    # project popularity roughly follows a Zipf law, BigQuery groups duplicate keys
+    size = rows * 3 // 2
+    ranks = np.minimum(rng.zipf(1.2, size=size), len(projects)) - 1
+    df = pd.DataFrame(
+        {
+            "cpu": _choice(rng, CPU_WEIGHTS, size),
+            "num_downloads": np.maximum(rng.lognormal(2.3, 2.5, size=size), 1).astype(np.int64),
+            "python_version": _choice(rng, PYTHON_WEIGHTS, size),
+            "glibc_version": _choice(rng, GLIBC_WEIGHTS, size),
+            "project": projects[ranks],
+        },
+    )
+    df = df.drop_duplicates(["cpu", "python_version", "glibc_version", "project"])
+    return df.sort_values("num_downloads", ascending=False, ignore_index=True)
+
+
+def generate_consumer_data(
+    path: Path,
+    packages: list[str],
+    start: date,
+    end: date,
+    rows: int,
+    seed: int,
+) -> None:
+    rng = np.random.default_rng(seed)
+    projects = rng.permutation(np.array(packages, dtype=object))
+    for date_ in update_consumer_stats.date_iterator(start, end):
+        df = _generate_consumer_day(rng, projects, rows)
+        folder = path / date_.strftime("%Y") / date_.strftime("%m")
+        folder.mkdir(parents=True, exist_ok=True)
+        file = folder / f"{date_.strftime('%d')}.csv"
+        df.to_csv(file.with_suffix(".csv.xz"), index=False)
+        df = df.groupby(["cpu", "python_version", "glibc_version"], as_index=False)[
+            "num_downloads"
+        ].sum()
+        df = df[["cpu", "num_downloads", "python_version", "glibc_version"]]
+        df.sort_values("num_downloads", ascending=False).to_csv(file, index=False)
+
+
+def generate_release_files(
+    packages: list[str],
+    seed: int,
+) -> Generator[tuple[str, str, dict[str, list[dict[str, Any]]]]]:
+    rng = np.random.default_rng(seed)
+    for package in packages:
+        name = package.replace("-", "_")
+        releases: dict[str, list[dict[str, Any]]] = {}
+        upload_date = date(2019, 1, 1) + timedelta(days=int(rng.integers(2000)))
+        minor = int(rng.integers(6, 11))
+        for index in range(rng.integers(1, 12)):
+            upload_date += timedelta(days=int(rng.integers(1, 120)))
+            minor = min(14, minor + int(rng.integers(2)))
+            version = f"{index}.{rng.integers(3)}" + ("rc1" if rng.random() < 0.1 else "")
+            platform_tag = rng.choice(MANYLINUX_TAGS)
+            kind = rng.random()
+            if kind < 0.1:
+                tags = [f"cp3{minor}-abi3"]
+            elif kind < 0.2:
+                tags = ["py3-none"]
+            else:
+                last_minor = min(14, minor + int(rng.integers(6)))
+                tags = [
+                    f"cp3{m}-cp3{m}{'m' if m < 8 else ''}" for m in range(minor, last_minor + 1)
+                ]
+            filenames = [f"{name}-{version}.tar.gz"]
+            filenames.extend(f"{name}-{version}-{tag}-{platform_tag}.whl" for tag in tags)
+            releases[version] = [
+                {
+                    "filename": filename,
+                    "upload_time": upload_date.isoformat(),
+                    "requires_python": f">=3.{minor}",
+                }
+                for filename in filenames
+            ]
+        yield package, f'"{rng.integers(2**63):016x}"', releases
+
+
+def generate_release_cache(path: Path, packages: list[str], seed: int) -> None:
+    path.mkdir(parents=True, exist_ok=True)
+    etag_cache: dict[str, tuple[str, bool]] = {}
+    infos: list[tuple[str, dict[str, Any]]] = []
+    for package, etag, files_by_version in generate_release_files(packages, seed):
+        releases = update_dataset.build_releases(package, files_by_version)
+        etag_cache[package] = (etag, True)
+        infos.append((package, update_dataset.dump_releases(etag, releases)))
+    with release_store.ReleaseStore(path / "releases.sqlite") as store:
+        store.put_infos(infos)
+        store.set_etags(etag_cache)
+
+
+def _redirect_paths(work_dir: Path) -> None:
+    cache_path = work_dir / "cache"
+    utils.CACHE_PATH = cache_path
+    utils.RELEASE_STORE_PATH = cache_path / "releases.sqlite"
+    utils.WHEEL_SUPPORT_MAP_PATH = cache_path / "wheel_support_map.json"
+    utils.CONSUMER_CACHE_PATH = cache_path / "consumer_data"
+    utils.CONSUMER_AGGREGATE_PATH = cache_path / "consumer_aggregates"
+    utils.CONSUMER_ROLLING_PATH = cache_path / "consumer_rolling.npz"
+    utils.CONSUMER_DATA_PATH = work_dir / "consumer-data.json"
+
+
+def _clear_derived_caches(work_dir: Path) -> None:
+    cache_path = work_dir / "cache"
+    for name in ("consumer_data", "consumer_aggregates"):
+        shutil.rmtree(cache_path / name, ignore_errors=True)
+    for name in ("wheel_support_map.json", "consumer_rolling.npz"):
+        cache_path.joinpath(name).unlink(missing_ok=True)
+
+
+def _get_packages(work_dir: Path) -> list[str]:
+    with release_store.ReleaseStore(work_dir / "cache" / "releases.sqlite") as store:
+        return store.get_packages()
+
+
+def _load_days(
+    wheel_support_map: update_consumer_stats.WheelSupportMap,
+    path: Path,
+    start: date,
+    end: date,
+) -> None:
+    for date_ in update_consumer_stats.date_iterator(start, end):
+        update_consumer_stats._load_df(wheel_support_map, path, date_)  # noqa: SLF001
+
+
+def _measure(stage: str, work_dir: Path, days: int, source: str) -> dict[str, float]:
+    # workers have to inherit the redirected paths
+    multiprocessing.set_start_method("fork")
+    _redirect_paths(work_dir)
+    packages = _get_packages(work_dir)
+    path = work_dir / source
+    start = END_DATE - timedelta(days=days - 1)
+    run: Callable[[], object]
+    if stage == "wheel_support_map":
+        run = functools.partial(update_consumer_stats._build_wheel_support_map, packages)  # noqa: SLF001
+    elif stage == "load_df":
+        wheel_support_map = update_consumer_stats._build_wheel_support_map(packages)  # noqa: SLF001
+        run = functools.partial(_load_days, wheel_support_map, path, start, END_DATE)
+    else:
+        run = functools.partial(update_consumer_stats.update, packages, path, start, END_DATE)
+    start_time = time.perf_counter()
+    run()
+    wall_time = time.perf_counter() - start_time
+    return {
+        "wall_time": wall_time,
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_rss_children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def _get_commit() -> str | None:
+    try:
+        completed = subprocess.run(
+            ["git", "rev-parse", "HEAD"],  # noqa: S607
+            cwd=utils.ROOT_PATH,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    except OSError, subprocess.CalledProcessError:
+        return None
+    return completed.stdout.strip()
+
+
+def _run_case(work_dir: Path, stage: str, days: int, source: str) -> dict[str, float]:
+    # each case runs in a fresh interpreter so that peak RSS is its own
+    completed = subprocess.run(  # noqa: S603
+        [
+            sys.executable,
+            __file__,
+            "--work-dir",
+            str(work_dir),
+            "--measure",
+            stage,
+            "--days",
+            str(days),
+            "--source",
+            source,
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    result: dict[str, float] = json.loads(completed.stdout.splitlines()[-1])
+    return result
+
+
+def _match_wheel_filename(filename: str) -> utils.WheelMetadata | None:
+    match = utils.WHEEL_INFO_RE.match(filename)
+    return None if match is None else utils.WheelMetadata(*match.groups()[1:])
+
+
+def _parse_wheel_filenames(
+    function: Callable[[str], utils.WheelMetadata | None],
+    filenames: list[str],
+) -> None:
+    for filename in filenames:
+        function(filename)
+
+
+def benchmark_wheel_filename(packages: list[str], seed: int) -> dict[str, Any]:
+    filenames = sorted(
+        {
+            file["filename"]
+            for _, _, files_by_version in generate_release_files(packages, seed)
+            for files in files_by_version.values()
+            for file in files
+        },
+    )
+    # the memoized parser would only measure cache hits
+    parser = utils.parse_wheel_filename.__wrapped__
+    for filename in filenames:
+        if parser(filename) != _match_wheel_filename(filename):
+            msg = f"parse_wheel_filename differs from WHEEL_INFO_RE for {filename!r}"
+            raise ValueError(msg)
+    result: dict[str, Any] = {"stage": "parse_wheel_filename", "filenames": len(filenames)}
+    for name, function in (("regex", _match_wheel_filename), ("parser", parser)):
+        parse_all = functools.partial(_parse_wheel_filenames, function, filenames)
+        result[f"{name}_time"] = min(timeit.repeat(parse_all, number=1))
+    _LOGGER.info(
+        "parse_wheel_filename (%d filenames): %.3fs, regex %.3fs",
+        len(filenames),
+        result["parser_time"],
+        result["regex_time"],
+    )
+    return result
+
+
+def run_benchmarks(
+    work_dir: Path,
+    windows: list[int],
+    load_days: int,
+) -> list[dict[str, Any]]:
+    cases = [("wheel_support_map", 0, "consumer_data")]
+    cases.extend(
+        ("load_df", load_days, source) for source in ("consumer_data", "consumer_data_csv")
+    )
+    cases.extend(("update", days, "consumer_data") for days in windows)
+    results = []
+    for stage, days, source in cases:
+        _clear_derived_caches(work_dir)
+        for cache in ("cold", "warm"):
+            result: dict[str, Any] = {
+                "stage": stage,
+                "source": source,
+                "days": days,
+                "cache": cache,
+            }
+            result.update(_run_case(work_dir, stage, days, source))
+            _LOGGER.info(
+                "%s (%s, %d days, %s cache): %.2fs, peak RSS %.0f MiB, workers %.0f MiB",
+                stage,
+                source,
+                days,
+                cache,
+                result["wall_time"],
+                result["peak_rss"],
+                result["peak_rss_children"],
+            )
+            results.append(result)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Offline benchmarks of the consumer statistics pipeline",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=Path,
+        help="directory holding the synthetic data, reused if it exists (default: temporary)",
+    )
+    parser.add_argument(
+        "--scale",
+        default="production",
+        choices=list(SCALES),
+        help="size of the synthetic data, smoke is only meant for quick checks",
+    )
+    parser.add_argument(
+        "--packages",
+        default=argparse.SUPPRESS,
+        type=int,
+        help="number of packages (default: from --scale)",
+    )
+    parser.add_argument(
+        "--rows",
+        default=argparse.SUPPRESS,
+        type=int,
+        help="rows per consumer data day (default: from --scale)",
+    )
+    parser.add_argument(
+        "--windows",
+        default=[7, 28, 91],
+        type=int,
+        nargs="+",
+        help="number of days of the update benchmarks",
+    )
+    parser.add_argument(
+        "--load-days",
+        default=7,
+        type=int,
+        help="number of days of the load benchmarks",
+    )
+    parser.add_argument("--seed", default=0, type=int, help="seed of the synthetic data")
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=Path("benchmark.json"),
+        type=Path,
+        help="output file",
+    )
+    parser.add_argument("-v", "--verbosity", action="count", help="increase output verbosity")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    parser.add_argument("--days", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--source", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        logging.basicConfig(level=logging.ERROR)
+        result = _measure(args.measure, args.work_dir, args.days, args.source)
+        sys.stdout.write(f"{json.dumps(result)}\n")
+        return
+
+    logging.basicConfig(level=30 - 10 * min(args.verbosity or 0, 2))
+    _LOGGER.setLevel(logging.INFO)
+    with TemporaryDirectory() as temp:
+        work_dir: Path = args.work_dir or Path(temp)
+        workload_file = work_dir / "workload.json"
+        if not (work_dir / "consumer_data").exists():
+            _LOGGER.info("generating synthetic data in %s", work_dir)
+            package_count, rows = SCALES[args.scale]
+            package_count = getattr(args, "packages", package_count)
+            rows = getattr(args, "rows", rows)
+            scale = args.scale if (package_count, rows) == SCALES[args.scale] else "custom"
+            packages = [f"bench-{index:05d}" for index in range(package_count)]
+            generate_release_cache(work_dir / "cache", packages, args.seed)
+            start = END_DATE - timedelta(days=max(*args.windows, args.load_days) - 1)
+            start -= utils.CONSUMER_WINDOW_SIZE
+            generate_consumer_data(
+                work_dir / "consumer_data",
+                packages,
+                start,
+                END_DATE,
+                rows,
+                args.seed,
+            )
+            shutil.copytree(
+                work_dir / "consumer_data",
+                work_dir / "consumer_data_csv",
+                ignore=shutil.ignore_patterns("*.xz"),
+            )
+            workload = {"scale": scale, "rows": rows, "seed": args.seed}
+            workload_file.write_text(json.dumps(workload))
+        # a reused work directory keeps the size it was generated with
+        workload = json.loads(workload_file.read_text()) if workload_file.exists() else {}
+        output = {
+            "commit": _get_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "cpu_count": os.cpu_count(),
+            "scale": workload.get("scale", "unknown"),
+            "packages": len(_get_packages(work_dir)),
+            "rows": workload.get("rows"),
+            "results": run_benchmarks(work_dir, args.windows, args.load_days),
+        }
+        # the release store only holds parsed records, filenames are generated again
+        output["results"].append(benchmark_wheel_filename(_get_packages(work_dir), args.seed))
+    with args.output.open("w") as f:
+        json.dump(output, f, indent=2)
+        f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
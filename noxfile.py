@@ -57,6 +57,19 @@ def run(session: nox.Session) -> None:
     session.run("python", "update.py", *session.posargs)
 
 
+@nox.session(python=PYTHON_VERSION)
+def benchmark(session: nox.Session) -> None:
+    """Run the offline benchmarks of the consumer statistics."""
+    session.install(
+        "--only-binary",
+        ":all:",
+        "--require-hashes",
+        "-r",
+        "requirements.txt",
+    )
+    session.run("python", "benchmark.py", *session.posargs)
+
+
 @nox.session(python=PYTHON_VERSION)
 def serve(session: nox.Session) -> None:
     session.run("python", "-m", "http.server", "-d", "build")
@@ -0,0 +1,282 @@
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+from typing import Any, Final, Self
+
+import utils
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from collections.abc import Container, Generator, Iterable
+    from pathlib import Path
+    from types import TracebackType
+
+_LOGGER = logging.getLogger(__name__)
+
+RELEASE_STORE_VERSION: Final[int] = 4
+
+_SCHEMA: Final[str] = """
+CREATE TABLE IF NOT EXISTS releases (
+    package TEXT PRIMARY KEY,
+    etag TEXT NOT NULL,
+    info TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS etags (
+    package TEXT PRIMARY KEY,
+    etag TEXT NOT NULL,
+    expect_cache INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS journal (
+    package TEXT NOT NULL,
+    name TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    etag TEXT,
+    expect_cache INTEGER NOT NULL,
+    time REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS projects (
+    name TEXT PRIMARY KEY
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class ReleaseStore:
+    # release info & etags of all packages in a single SQLite database, the connection
+    # is shared by the threads of a process
+    def __init__(self, path: Path) -> None:
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+        if version not in range(RELEASE_STORE_VERSION + 1):
+            msg = f"unsupported release store version {version} in {path}"
+            raise ValueError(msg)
+        if version < RELEASE_STORE_VERSION:
+            self._migrate(version, path.parent)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _migrate(self, version: int, cache_path: Path) -> None:
+        # tables missing from older versions are created, version 0 also imports the legacy
+        # info/*.json & etag_cache.json layout next to the store once, imports are
+        # idempotent so an interrupted migration is done again
+        self._connection.executescript(_SCHEMA)
+        legacy_paths: list[Path] = []
+        if version == 0:
+            info_path = cache_path / "info"
+            etag_cache_path = cache_path / "etag_cache.json"
+            if etag_cache_path.exists():
+                self.set_etags(json.loads(etag_cache_path.read_text()))
+            cache_files = sorted(info_path.glob("*.json"))
+            if cache_files:
+                _LOGGER.info("migrating %d release cache files", len(cache_files))
+            self.put_infos(
+                (cache_file.stem, json.loads(cache_file.read_text())) for cache_file in cache_files
+            )
+            legacy_paths = [info_path, etag_cache_path]
+        with self._lock, self._connection:
+            self._connection.execute(f"PRAGMA user_version={RELEASE_STORE_VERSION}")
+        for legacy_path in legacy_paths:
+            if legacy_path.is_dir():
+                shutil.rmtree(legacy_path)
+            else:
+                legacy_path.unlink(missing_ok=True)
+
+    def get_info(self, package: str) -> dict[str, Any] | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT info FROM releases WHERE package = ?",
+                (package,),
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def get_info_etag(self, package: str) -> str | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT etag FROM releases WHERE package = ?",
+                (package,),
+            ).fetchone()
+        return None if row is None else str(row[0])
+
+    def get_info_schema(self, package: str) -> int | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT json_extract(info, '$.schema') FROM releases WHERE package = ?",
+                (package,),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def get_outdated_packages(self, schema: int) -> list[str]:
+        # records without a schema are upgraded from the stored files, they aren't outdated
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT package FROM releases WHERE json_extract(info, '$.schema') != ? "
+                "ORDER BY package",
+                (schema,),
+            ).fetchall()
+        return [package for (package,) in rows]
+
+    def has_info(self, package: str) -> bool:
+        return self.get_info_etag(package) is not None
+
+    def iter_infos(
+        self,
+        packages: Container[str],
+    ) -> Generator[tuple[str, str, dict[str, Any]]]:
+        # a single ordered scan of the stored info, only the one of packages is decoded
+        with self._lock:
+            cursor = self._connection.execute(
+                "SELECT package, etag, info FROM releases ORDER BY package",
+            )
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(256)
+            if not rows:
+                break
+            for package, etag, info in rows:
+                if package in packages:
+                    yield package, etag, json.loads(info)
+
+    def get_packages(self) -> list[str]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT package FROM releases ORDER BY package",
+            ).fetchall()
+        return [package for (package,) in rows]
+
+    def put_info(self, package: str, info: dict[str, Any]) -> None:
+        self.put_infos([(package, info)])
+
+    def put_infos(self, infos: Iterable[tuple[str, dict[str, Any]]]) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO releases VALUES (?, ?, ?)",
+                ((package, info.get("etag", ""), json.dumps(info)) for package, info in infos),
+            )
+
+    def get_etags(self) -> dict[str, tuple[str, bool]]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT package, etag, expect_cache FROM etags",
+            ).fetchall()
+        return {package: (etag, bool(expect_cache)) for package, etag, expect_cache in rows}
+
+    def set_etags(self, etags: dict[str, tuple[str, bool]]) -> None:
+        # the etags include the journaled ones, the journal is compacted along the way
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM journal")
+            self._connection.execute("DELETE FROM etags")
+            self._connection.executemany(
+                "INSERT INTO etags VALUES (?, ?, ?)",
+                (
+                    (package, etag, int(expect_cache))
+                    for package, (etag, expect_cache) in sorted(etags.items())
+                ),
+            )
+
+    def get_journal(self) -> list[tuple[str, str, int, str | None, bool, float]]:
+        # package updates since the last compaction of the etags, in order
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT package, name, status, etag, expect_cache, time FROM journal "
+                "ORDER BY rowid",
+            ).fetchall()
+        return [
+            (package, name, status, etag, bool(expect_cache), time)
+            for package, name, status, etag, expect_cache, time in rows
+        ]
+
+    def append_journal(
+        self,
+        entries: Iterable[tuple[str, str, int, str | None, bool, float]],
+    ) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO journal VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (package, name, status, etag, int(expect_cache), time)
+                    for package, name, status, etag, expect_cache, time in entries
+                ),
+            )
+
+    def get_projects(self) -> tuple[list[str], dict[str, str]]:
+        # the names of all PyPI projects & the validators of the listing they come from
+        with self._lock:
+            rows = self._connection.execute("SELECT name FROM projects ORDER BY name").fetchall()
+            row = self._connection.execute(
+                "SELECT value FROM state WHERE key = 'projects_validators'",
+            ).fetchone()
+        return [name for (name,) in rows], {} if row is None else json.loads(row[0])
+
+    def set_projects(self, projects: Iterable[str], validators: dict[str, str]) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM projects")
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO projects VALUES (?)",
+                ((name,) for name in projects),
+            )
+            self._set_projects_validators(validators)
+
+    def set_projects_validators(self, validators: dict[str, str]) -> None:
+        with self._lock, self._connection:
+            self._set_projects_validators(validators)
+
+    def _set_projects_validators(self, validators: dict[str, str]) -> None:
+        self._connection.execute(
+            "INSERT OR REPLACE INTO state VALUES ('projects_validators', ?)",
+            (json.dumps(validators),),
+        )
+
+    def get_state(self, key: str) -> str | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM state WHERE key = ?",
+                (key,),
+            ).fetchone()
+        return None if row is None else str(row[0])
+
+    def set_state(self, key: str, value: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, value))
+
+
+_store: ReleaseStore | None = None
+_store_pid = 0
+
+
+def get_store() -> ReleaseStore:
+    # connections can't be shared with forked processes
+    global _store, _store_pid  # noqa: PLW0603
+    if _store is None or _store_pid != os.getpid():
+        utils.CACHE_PATH.mkdir(exist_ok=True)
+        _store = ReleaseStore(utils.RELEASE_STORE_PATH)
+        _store_pid = os.getpid()
+    return _store
+
+
+def close_store() -> None:
+    global _store  # noqa: PLW0603
+    if _store is not None and _store_pid == os.getpid():
+        _store.close()
+    _store = None
@@ -1,11 +1,11 @@
 import argparse
 import json
 import logging
-import os
 from datetime import UTC, date, datetime, timedelta
 from pathlib import Path
 from shutil import copy, rmtree
 
+import release_store
 import update_cache
 import update_consumer_data
 import update_consumer_stats
@@ -13,6 +13,10 @@ import update_dataset
 import update_stats
 import utils
 
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    import os
+
 _LOGGER = logging.getLogger(__name__)
 
 
@@ -54,6 +58,36 @@ def main() -> None:
         help="end date",
     )
     parser.add_argument("--skip-cache", action="store_true", help="skip cache update")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip packages already updated by an interrupted cache update",
+    )
+    parser.add_argument(
+        "--fetch-concurrency",
+        default=64,
+        type=int,
+        help="maximum number of concurrent requests to PyPI",
+    )
+    parser.add_argument(
+        "--fetch-timeout",
+        default=30.0,
+        type=float,
+        help="timeout of requests to PyPI in seconds",
+    )
+    parser.add_argument(
+        "--project-api",
+        default=update_cache.ProjectApi.JSON.value,
+        choices=[api.value for api in update_cache.ProjectApi],
+        help="PyPI API used to get project releases",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        type=int,
+        help="number of workers used to build the dataset",
+    )
     parser.add_argument(
         "--bigquery-credentials",
         type=check_file,
@@ -72,12 +106,6 @@ def main() -> None:
         msg = f"start date ({start}) is after end date ({end})"
         raise ValueError(msg)
 
-    if "GITHUB_EVENT_NAME" in os.environ:
-        event_name = os.environ["GITHUB_EVENT_NAME"]
-        if event_name == "schedule" and today.isoweekday() == 1:
-            # check every PyPI packages every Monday
-            args.all_pypi_packages = True
-
     if utils.BUILD_PATH.exists():
         rmtree(utils.BUILD_PATH)
     utils.BUILD_PATH.mkdir()
@@ -94,15 +122,27 @@ def main() -> None:
         utils.ROOT_PATH / "consumer_data",
         args.bigquery_credentials,
     )
-    update_consumer_stats.update(packages, utils.ROOT_PATH / "consumer_data", start, end)
 
     if not args.skip_cache:
-        packages = update_cache.update(packages, all_pypi_packages=args.all_pypi_packages)
-
-    packages, rows = update_dataset.update(packages)
+        packages = update_cache.update(
+            packages,
+            all_pypi_packages=args.all_pypi_packages,
+            max_concurrency=args.fetch_concurrency,
+            timeout=args.fetch_timeout,
+            api=update_cache.ProjectApi(args.project_api),
+            resume=args.resume,
+        )
+    # removed_packages.json has been refreshed along with the package list
+    consumer_packages = packages
+
+    packages, rows = update_dataset.update(packages, jobs=args.jobs)
     with utils.ROOT_PATH.joinpath("packages.json").open("w") as f:
         json.dump(packages, f, indent=0)
         f.write("\n")
+    # the wheel support map is derived from the releases indexed by the dataset update
+    update_consumer_stats.update(consumer_packages, utils.ROOT_PATH / "consumer_data", start, end)
+    # checkpoints the write-ahead log into the store before it gets cached
+    release_store.close_store()
     update_stats.update(rows, start, end)
     copy(utils.ROOT_PATH / "index.html", utils.BUILD_PATH)
     copy(utils.ROOT_PATH / "style.css", utils.BUILD_PATH)
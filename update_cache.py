@@ -1,20 +1,65 @@
+import codecs
+import contextlib
 import functools
 import json
 import logging
+import random
+import re
+import threading
+import time
 import urllib.parse
-from dataclasses import dataclass
+import xmlrpc.client
+import zlib
+from dataclasses import dataclass, field
 from datetime import UTC, date, datetime
+from email.utils import parsedate_to_datetime
 from enum import Enum
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from typing import Any
+from typing import Any, Final, cast
 
 import requests
-from packaging.utils import canonicalize_name
-
+from packaging.utils import (
+    InvalidSdistFilename,
+    canonicalize_name,
+    canonicalize_version,
+    parse_sdist_filename,
+)
+
+import release_store
+import update_dataset
 import utils
 
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from collections.abc import Generator, Iterator
+
 _LOGGER = logging.getLogger(__name__)
+_MAX_CONCURRENCY: Final[int] = 64
+_INITIAL_CONCURRENCY: Final[int] = 8
+_TIMEOUT: Final[float] = 30.0
+_MAX_ATTEMPTS: Final[int] = 4
+_BACKOFF: Final[float] = 1.0
+_MAX_RETRY_AFTER: Final[float] = 300.0
+# beyond that many events since the last refresh, a full sweep is cheaper
+_MAX_CHANGELOG_SERIALS: Final[int] = 1_000_000
+# one shard of all PyPI packages is checked per run, a week for nightly runs
+_DISCOVERY_SHARDS: Final[int] = 7
+# progress is journaled at least that often, that's what a killed run loses
+_CHECKPOINT_INTERVAL: Final[float] = 30.0
+# packages journaled that recently aren't fetched again when resuming
+_RESUME_WINDOW: Final[float] = 12 * 3600.0
+_CHUNK_SIZE: Final[int] = 1 << 16
+_JSON_DECODER: Final[json.JSONDecoder] = json.JSONDecoder()
+_JSON_WHITESPACE: Final[re.Pattern[str]] = re.compile(r"[ \t\n\r]*")
+_JSON_NUMBER_ENDS: Final[frozenset[str]] = frozenset(" \t\n\r,]}")
+_SESSIONS = threading.local()
+
+
+class ProjectApi(Enum):
+    # legacy /pypi/<project>/json or PEP 691 & 700 /simple/<project>/ JSON
+    JSON = "json"
+    SIMPLE = "simple"
 
 
 class Status(Enum):
@@ -32,8 +77,391 @@ class PackageStatus:
     expect_cache: bool = False
 
 
-def _build_url(package: str) -> str:
-    return f"https://pypi.org/pypi/{package}/json"
+@dataclass
+class _UpdateOutcome:
+    etag_cache: dict[str, tuple[str, bool]]
+    to_remove: set[str] = field(default_factory=set)
+    to_add: set[str] = field(default_factory=set)
+    failed: set[str] = field(default_factory=set)
+
+    def apply(self, package: str, package_status: PackageStatus) -> None:
+        if package_status.etag is not None:
+            self.etag_cache[package_status.name] = (
+                package_status.etag,
+                package_status.expect_cache,
+            )
+        if package_status.status == Status.REMOVED:
+            self.to_remove.add(package_status.name)
+            self.etag_cache[package_status.name] = ("", False)
+        elif package_status.status == Status.ERROR:
+            self.failed.add(package)
+        elif package_status.name != package:
+            self.to_remove.add(package)
+            self.etag_cache[package] = ("", False)
+            self.to_add.add(package_status.name)
+
+
+class _Journal:
+    # append-only log of the final package statuses of a run, checkpointed in the store
+    # periodically & compacted in the etags at the end of the run
+    def __init__(self, store: release_store.ReleaseStore) -> None:
+        self._store = store
+        self._pending: list[tuple[str, str, int, str | None, bool, float]] = []
+        self._checkpoint = time.monotonic()
+
+    def append(self, package: str, package_status: PackageStatus) -> None:
+        self._pending.append(
+            (
+                package,
+                package_status.name,
+                package_status.status.value,
+                package_status.etag,
+                package_status.expect_cache,
+                time.time(),
+            ),
+        )
+        if time.monotonic() - self._checkpoint >= _CHECKPOINT_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        self._store.append_journal(self._pending)
+        self._pending.clear()
+        self._checkpoint = time.monotonic()
+
+
+def _get_session() -> requests.Session:
+    # sessions aren't thread-safe, each thread keeps its own connection alive to skip the
+    # TCP & TLS handshakes, responses are gzip encoded by default
+    session: requests.Session | None = getattr(_SESSIONS, "session", None)
+    if session is None:
+        session = requests.Session()
+        for prefix in ("https://", "http://"):
+            session.mount(prefix, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        session.headers["User-Agent"] = utils.USER_AGENT
+        _SESSIONS.session = session
+    return session
+
+
+class _JsonStream:
+    # incremental reader of a JSON document, values are decoded one at a time so only the
+    # current one & a chunk of the document are held in memory
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        self._chunks = chunks
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        # the pending text at least doubles, values spanning many chunks are decoded again
+        # a logarithmic number of times
+        if self._eof:
+            return False
+        parts = [self._buffer[self._pos :]]
+        pending = len(parts[0])
+        size = 0
+        while size <= pending and not self._eof:
+            chunk = next(self._chunks, None)
+            self._eof = chunk is None
+            parts.append(self._decoder.decode(chunk or b"", final=self._eof))
+            size += len(parts[-1])
+        self._buffer = "".join(parts)
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        if self._pos < len(self._buffer) and self._buffer[self._pos] not in " \t\n\r":
+            return self._buffer[self._pos]
+        while True:
+            match = _JSON_WHITESPACE.match(self._buffer, self._pos)
+            assert match is not None
+            self._pos = match.end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ""
+
+    def consume(self, char: str) -> None:
+        if self.peek() != char:
+            msg = f"expected {char!r} in JSON document"
+            raise ValueError(msg)
+        self._pos += 1
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = _JSON_DECODER.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number only ends before a delimiter, without one it might continue in the
+            # next chunk ("0." or "1e" are decoded as 0 & 1)
+            if (
+                not isinstance(value, int | float)
+                or self._buffer[end : end + 1] in _JSON_NUMBER_ENDS
+                or not self._fill()
+            ):
+                self._pos = end
+                return value
+
+    def iter_object(self) -> Generator[str]:
+        # yields the keys, values shall be read before getting the next key
+        self.consume("{")
+        if self.peek() != "}":
+            while True:
+                key = self.value()
+                self.consume(":")
+                yield key
+                if self.peek() != ",":
+                    break
+                self._pos += 1
+        self.consume("}")
+
+    def iter_array(self) -> Generator[Any]:
+        self.consume("[")
+        if self.peek() != "]":
+            while True:
+                yield self.value()
+                if self.peek() != ",":
+                    break
+                self._pos += 1
+        self.consume("]")
+
+
+def _parse_retry_after(value: str | None) -> float:
+    if value is None:
+        return 0.0
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(tz=UTC)).total_seconds()
+        except TypeError, ValueError:
+            return 0.0
+    return min(max(delay, 0.0), _MAX_RETRY_AFTER)
+
+
+class _FetchScheduler:
+    # AIMD limit on concurrent requests, congestion is a 429, a 5xx, a network error or a
+    # response slower than half the timeout: slow start (+1 per success) until the first
+    # congestion, then +1 per limit successes & halved at most once per round trip
+    def __init__(self, max_concurrency: int, timeout: float) -> None:
+        self._max_concurrency = max_concurrency
+        self._timeout = timeout
+        self._limit = float(min(_INITIAL_CONCURRENCY, max_concurrency))
+        self._slow_start = True
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._decreased_at = 0.0
+        self._condition = threading.Condition()
+
+    def _acquire(self) -> float:
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    self._condition.wait(self._paused_until - now)
+                elif self._in_flight >= int(self._limit):
+                    self._condition.wait()
+                else:
+                    self._in_flight += 1
+                    return now
+
+    def _release(self, started: float, *, congested: bool, retry_after: float = 0.0) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + retry_after)
+            if congested:
+                # requests sent before the last decrease don't reflect it
+                if started >= self._decreased_at:
+                    self._slow_start = False
+                    self._limit = max(1.0, self._limit / 2)
+                    self._decreased_at = now
+                    _LOGGER.info("fetch concurrency decreased to %d", self._limit)
+            elif self._slow_start:
+                self._limit = min(self._limit + 1, self._max_concurrency)
+            else:
+                self._limit = min(self._limit + 1 / self._limit, self._max_concurrency)
+            self._condition.notify_all()
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        headers: dict[str, str],
+        data: bytes | None = None,
+    ) -> requests.Response:
+        return self._send(method, url, headers, data, stream=False)[0]
+
+    @contextlib.contextmanager
+    def stream(
+        self,
+        method: str,
+        url: str,
+        headers: dict[str, str],
+    ) -> Generator[requests.Response]:
+        # the body of a successful response is read within the context, its request keeps
+        # counting against the limit & towards a slow response until then
+        response, started = self._send(method, url, headers, None, stream=True)
+        congested = False
+        try:
+            yield response
+        except requests.exceptions.RequestException:
+            congested = True
+            raise
+        finally:
+            response.close()
+            if started is not None:
+                slow = time.monotonic() - started > self._timeout / 2
+                self._release(started, congested=congested or slow)
+
+    def _send(
+        self,
+        method: str,
+        url: str,
+        headers: dict[str, str],
+        data: bytes | None,
+        *,
+        stream: bool,
+    ) -> tuple[requests.Response, float | None]:
+        # the start of the request is returned when it still holds its slot
+        attempt = 0
+        while True:
+            attempt += 1
+            started = self._acquire()
+            try:
+                response = _get_session().request(
+                    method,
+                    url,
+                    headers=headers,
+                    data=data,
+                    timeout=self._timeout,
+                    stream=stream,
+                )
+                if stream and response.status_code != 200:
+                    # only successful responses are streamed, the connection is released
+                    response.raw.drain_conn()
+            except requests.exceptions.ConnectionError, requests.exceptions.Timeout:
+                self._release(started, congested=True)
+                if attempt == _MAX_ATTEMPTS:
+                    raise
+            except requests.exceptions.RequestException:
+                self._release(started, congested=False)
+                raise
+            else:
+                if response.status_code != 429 and response.status_code < 500:
+                    if stream and response.status_code == 200:
+                        return response, started
+                    slow = response.elapsed.total_seconds() > self._timeout / 2
+                    self._release(started, congested=slow)
+                    return response, None
+                retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+                self._release(started, congested=True, retry_after=retry_after)
+                if attempt == _MAX_ATTEMPTS:
+                    return response, None
+            # full jitter spreads the retries of requests that failed together
+            time.sleep(random.uniform(0, _BACKOFF * 2**attempt))  # noqa: S311
+
+
+def _get_changed_packages(
+    scheduler: _FetchScheduler,
+    since_serial: int,
+    last_serial: int,
+) -> set[str] | None:
+    changed: set[str] = set()
+    serial = since_serial
+    while serial < last_serial:
+        body = xmlrpc.client.dumps((serial,), "changelog_since_serial").encode()
+        try:
+            response = scheduler.request(
+                "POST",
+                f"{utils.PYPI_URL}/pypi",
+                {"Content-Type": "text/xml"},
+                body,
+            )
+            response.raise_for_status()
+            params, _ = xmlrpc.client.loads(response.content)
+        except (requests.exceptions.RequestException, xmlrpc.client.Error) as e:
+            _LOGGER.warning('error "%s" when retrieving the changelog', e)
+            return None
+        events = cast("list[tuple[str, str | None, int, str, int]]", params[0])
+        if not events:
+            break
+        # events are ordered by serial
+        changed.update(canonicalize_name(name) for name, *_ in events)
+        serial = events[-1][4]
+    return changed
+
+
+def _get_last_serial(scheduler: _FetchScheduler) -> str | None:
+    body = xmlrpc.client.dumps((), "changelog_last_serial").encode()
+    try:
+        response = scheduler.request(
+            "POST",
+            f"{utils.PYPI_URL}/pypi",
+            {"Content-Type": "text/xml"},
+            body,
+        )
+        response.raise_for_status()
+        params, _ = xmlrpc.client.loads(response.content)
+    except (requests.exceptions.RequestException, xmlrpc.client.Error) as e:
+        _LOGGER.warning('error "%s" when retrieving the last serial', e)
+        return None
+    return str(params[0])
+
+
+def _get_all_packages(
+    scheduler: _FetchScheduler,
+    store: release_store.ReleaseStore,
+) -> tuple[list[str], str | None]:
+    # the listing is revalidated against the cached one, names are only decoded, one
+    # project at a time, when it changed
+    projects, validators = store.get_projects()
+    headers = {"Accept": "application/vnd.pypi.simple.v1+json"}
+    if projects:
+        if "etag" in validators:
+            headers["If-None-Match"] = validators["etag"]
+        if "last_modified" in validators:
+            headers["If-Modified-Since"] = validators["last_modified"]
+    names: set[str] = set()
+    with scheduler.stream("GET", f"{utils.PYPI_URL}/simple/", headers) as response:
+        if response.status_code != 304:
+            response.raise_for_status()
+            stream = _JsonStream(response.iter_content(_CHUNK_SIZE))
+            for key in stream.iter_object():
+                if key != "projects":
+                    stream.value()
+                    continue
+                names.update(canonicalize_name(project["name"]) for project in stream.iter_array())
+    if response.status_code == 304:
+        _LOGGER.info("PyPI packages not modified since the last refresh")
+        # the serial moves with every release, not only with the listing
+        last_serial = response.headers.get("X-PyPI-Last-Serial") or _get_last_serial(scheduler)
+        if last_serial is not None:
+            validators["last_serial"] = last_serial
+            store.set_projects_validators(validators)
+        return projects, last_serial
+    projects = sorted(names)
+    validators = {
+        name: response.headers[header]
+        for name, header in (
+            ("etag", "ETag"),
+            ("last_modified", "Last-Modified"),
+            ("last_serial", "X-PyPI-Last-Serial"),
+        )
+        if header in response.headers
+    }
+    store.set_projects(projects, validators)
+    return projects, validators.get("last_serial")
+
+
+def _build_url(api: ProjectApi, package: str) -> str:
+    if api == ProjectApi.SIMPLE:
+        return f"{utils.PYPI_URL}/simple/{package}/"
+    return f"{utils.PYPI_URL}/pypi/{package}/json"
 
 
 def _check_cache_valid(info: Any) -> bool:
@@ -48,124 +476,238 @@ def _check_cache_valid(info: Any) -> bool:
     return True
 
 
+def _filter_files(package: str, files: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    new_files = []
+    upload_date_min = date.max
+    for file in files:
+        upload_date = datetime.fromisoformat(file["upload_time"]).date()
+        upload_date_min = min(upload_date_min, upload_date)
+        filename = file["filename"]
+        if not filename.lower().endswith(".whl"):
+            continue
+        metadata = utils.parse_wheel_filename(filename)
+        if metadata is None:
+            _LOGGER.warning('"%s":invalid wheel name "%s"', package, filename)
+            continue  # invalid name
+        if "manylinux" not in metadata.platform:
+            continue
+        requires_python = file["requires_python"]
+        new_files.append(
+            {
+                "filename": filename,
+                "upload_time": upload_date.isoformat(),
+                "requires_python": requires_python,
+            },
+        )
+
+    if len(new_files) > 0:
+        new_files.insert(
+            0,
+            {
+                "filename": "ut-1.zip",
+                "upload_time": upload_date_min.isoformat(),
+                "requires_python": None,
+            },
+        )
+    return new_files
+
+
+def _read_releases(package: str, response: requests.Response) -> dict[str, list[dict[str, Any]]]:
+    # project documents can be huge, "releases" is streamed & its files are decoded one
+    # release at a time to keep manylinux wheels only, other values are small enough
+    releases = {}
+    stream = _JsonStream(response.iter_content(_CHUNK_SIZE))
+    for key in stream.iter_object():
+        if key != "releases":
+            stream.value()
+            continue
+        for release in stream.iter_object():
+            files = _filter_files(package, stream.value())
+            if len(files) > 0:
+                releases[release] = files
+    return releases
+
+
+@functools.lru_cache(maxsize=4096)
+def _canonicalize_version(version: str) -> str:
+    return canonicalize_version(version, strip_trailing_zero=False)
+
+
+def _get_file_version(filename: str) -> str | None:
+    if filename.endswith(".whl"):
+        metadata = utils.parse_wheel_filename(filename)
+        return None if metadata is None else _canonicalize_version(metadata.version)
+    try:
+        _, version = parse_sdist_filename(filename)
+    except InvalidSdistFilename:
+        return None
+    return _canonicalize_version(str(version))
+
+
+def _read_simple_releases(
+    package: str,
+    response: requests.Response,
+) -> dict[str, list[dict[str, Any]]]:
+    # files aren't grouped by release, they're grouped by the version in their name (files
+    # other than wheels & sdists are ignored) & matched with the releases at the end, the
+    # earliest upload & the manylinux wheel candidates are the only things kept per release
+    files_by_version: dict[str, list[dict[str, Any]]] = {}
+    versions: list[str] = []
+    stream = _JsonStream(response.iter_content(_CHUNK_SIZE))
+    for key in stream.iter_object():
+        if key == "versions":
+            versions = stream.value()
+            continue
+        if key != "files":
+            stream.value()
+            continue
+        for file in stream.iter_array():
+            filename = file["filename"]
+            version = _get_file_version(filename)
+            # the upload time is optional in PEP 700, files without one can't be dated
+            upload_time = file.get("upload-time")
+            if version is None or upload_time is None:
+                continue
+            files = files_by_version.setdefault(
+                version,
+                [{"filename": "ut-1.zip", "upload_time": upload_time, "requires_python": None}],
+            )
+            files[0]["upload_time"] = min(files[0]["upload_time"], upload_time)
+            if filename.lower().endswith(".whl") and "manylinux" in filename:
+                files.append(
+                    {
+                        "filename": filename,
+                        "upload_time": upload_time,
+                        "requires_python": file.get("requires-python"),
+                    },
+                )
+    releases = {_canonicalize_version(version): version for version in versions}
+    result = {}
+    for version, files in files_by_version.items():
+        new_files = _filter_files(package, files)
+        if len(new_files) > 0:
+            result[releases.get(version, version)] = new_files
+    return result
+
+
 def _package_update(
+    scheduler: _FetchScheduler,
+    api: ProjectApi,
     etag_cache: dict[str, tuple[str, bool]],
     package: str,
     *,
     handle_moved: bool = False,
 ) -> PackageStatus:
     _LOGGER.info('"%s": begin update', package)
-    headers = {"User-Agent": utils.USER_AGENT}
+    headers = {}
+    if api == ProjectApi.SIMPLE:
+        headers["Accept"] = "application/vnd.pypi.simple.v1+json"
     package_new_name = package
     package_etag_cache = etag_cache.get(package)
+    store = release_store.get_store()
+    schema = store.get_info_schema(package)
+    if schema not in {None, update_dataset.RELEASE_RECORD_VERSION}:
+        # outdated release records can't be upgraded from the cache
+        package_etag_cache = None
     if package_etag_cache is not None:
         headers["If-None-Match"] = package_etag_cache[0]
 
+    etag = ""
+    files_by_version = None
+    # the body is read while the request holds its slot in the scheduler
     try:
-        response = requests.get(_build_url(package), headers=headers)
-    except requests.exceptions.RequestException as e:
-        _LOGGER.error('"%s": error "%s" when retrieving info', package, e)  # noqa: TRY400
-        return PackageStatus(package, Status.ERROR)
-
-    try:
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        if response.status_code == 404:
-            _LOGGER.warning('"%s": not available on PyPI anymore', package)
-            return PackageStatus(package, Status.REMOVED)
+        with scheduler.stream("GET", _build_url(api, package), headers) as response:
+            if response.status_code == 404:
+                _LOGGER.warning('"%s": not available on PyPI anymore', package)
+                return PackageStatus(package, Status.REMOVED)
+            response.raise_for_status()
+            for response_prev in response.history[::-1]:
+                if response_prev.status_code == 301:
+                    if not handle_moved:
+                        return PackageStatus(package, Status.MOVED)
+                    new_location = response_prev.headers["location"]
+                    uri = urllib.parse.urlparse(new_location)
+                    path = Path(uri.path)
+                    package_new_name = canonicalize_name(
+                        path.name if api == ProjectApi.SIMPLE else path.parent.name,
+                    )
+                    assert package_new_name != package
+                    _LOGGER.info('"%s": new name "%s"', package, package_new_name)
+                    break
+            if response.status_code != 304:
+                etag = response.headers["etag"]
+                if api == ProjectApi.SIMPLE:
+                    files_by_version = _read_simple_releases(package, response)
+                else:
+                    files_by_version = _read_releases(package, response)
+    except (requests.exceptions.RequestException, ValueError) as e:
         _LOGGER.error('"%s": error "%s" when retrieving info', package, e)  # noqa: TRY400
         return PackageStatus(package, Status.ERROR)
-    for response_prev in response.history[::-1]:
-        if response_prev.status_code == 301:
-            if not handle_moved:
-                return PackageStatus(package, Status.MOVED)
-            new_location = response_prev.headers["location"]
-            uri = urllib.parse.urlparse(new_location)
-            package_new_name = canonicalize_name(Path(uri.path).parent.name)
-            assert package_new_name != package
-            _LOGGER.info('"%s": new name "%s"', package, package_new_name)
-            break
 
-    cache_file = utils.get_release_cache_path(package)
-    if response.status_code == 304:
+    if files_by_version is None:
         assert package_etag_cache is not None
-        if package_new_name != package or (package_etag_cache[1] and not cache_file.exists()):
-            return _package_update({}, package_new_name, handle_moved=handle_moved)
-        return PackageStatus(package_new_name, Status.PROCESSED)
-    if package_new_name != package:
-        cache_file = utils.get_release_cache_path(package_new_name)
-
-    info = response.json()
-    # add 'etag' and filter-out what we don't need
-    info = {"etag": response.headers["etag"], "releases": info["releases"]}
-    for release in list(info["releases"]):
-        new_files = []
-        upload_date_min = date.max
-        for file in info["releases"][release]:
-            upload_date = datetime.fromisoformat(file["upload_time"]).date()
-            upload_date_min = min(upload_date_min, upload_date)
-            filename = file["filename"]
-            if not filename.lower().endswith(".whl"):
-                continue
-            parsed_filename = utils.WHEEL_INFO_RE.match(filename)
-            if parsed_filename is None:
-                _LOGGER.warning('"%s":invalid wheel name "%s"', package, filename)
-                continue  # invalid name
-            metadata = utils.WheelMetadata(*parsed_filename.groups()[1:])
-            if "manylinux" not in metadata.platform:
-                continue
-            requires_python = file["requires_python"]
-            new_files.append(
-                {
-                    "filename": filename,
-                    "upload_time": upload_date.isoformat(),
-                    "requires_python": requires_python,
-                },
+        if package_new_name != package or (package_etag_cache[1] and not store.has_info(package)):
+            return _package_update(
+                scheduler,
+                api,
+                {},
+                package_new_name,
+                handle_moved=handle_moved,
             )
+        return PackageStatus(package_new_name, Status.PROCESSED)
 
-        if len(new_files) > 0:
-            new_files.insert(
-                0,
-                {
-                    "filename": "ut-1.zip",
-                    "upload_time": upload_date_min.isoformat(),
-                    "requires_python": None,
-                },
-            )
-            info["releases"][release] = new_files
-        else:
-            info["releases"].pop(release)
-    if len(info["releases"]) > 0:
-        with cache_file.open("w") as f:
-            json.dump(info, f)
+    if len(files_by_version) > 0:
+        releases = update_dataset.build_releases(package_new_name, files_by_version)
+        store.put_info(package_new_name, update_dataset.dump_releases(etag, releases))
     return PackageStatus(
         package_new_name,
         Status.PROCESSED,
-        info["etag"],
-        len(info["releases"]) > 0,
+        etag,
+        len(files_by_version) > 0,
     )
 
 
-def update(packages: list[str], *, all_pypi_packages: bool = False) -> list[str]:
-    utils.RELEASE_INFO_PATH.mkdir(exist_ok=True)
-    etag_cache_path = utils.CACHE_PATH / "etag_cache.json"
-
-    etag_cache: dict[str, tuple[str, bool]] = {}
-    if etag_cache_path.exists():
-        with etag_cache_path.open() as f:
-            etag_cache = json.load(f)
-
-    new_etag_cache = etag_cache.copy()
-
-    _LOGGER.info("Getting list of all PyPI packages ... ")
-    headers = {
-        "User-Agent": utils.USER_AGENT,
-        "Accept": "application/vnd.pypi.simple.v1+json",
-    }
-    response = requests.get("https://pypi.org/simple/", headers=headers)
-    response.raise_for_status()
-    data = response.json()["projects"]
-    all_packages: list[str] = [canonicalize_name(project["name"]) for project in data]
+def update(
+    packages: list[str],
+    *,
+    all_pypi_packages: bool = False,
+    max_concurrency: int = _MAX_CONCURRENCY,
+    timeout: float = _TIMEOUT,
+    api: ProjectApi = ProjectApi.JSON,
+    resume: bool = False,
+) -> list[str]:
+    store = release_store.get_store()
+    etag_cache = store.get_etags()
+    scheduler = _FetchScheduler(max_concurrency, timeout)
+
+    # the progress of an interrupted run is in the journal, its packages are skipped when
+    # resuming it
+    replay = _UpdateOutcome(etag_cache)
+    resumed: dict[str, PackageStatus] = {}
+    resume_start = time.time() - _RESUME_WINDOW
+    for package, name, status, etag, expect_cache, journaled_at in store.get_journal():
+        package_status = PackageStatus(name, Status(status), etag, expect_cache)
+        replay.apply(package, package_status)
+        if resume and journaled_at >= resume_start:
+            resumed[package] = package_status
+    outcome = _UpdateOutcome(etag_cache.copy())
+
+    # new projects show up in the changelog, the listing is only needed once per discovery
+    # cycle to drop removed projects, when there's no changelog or for all packages
+    since_serial = store.get_state("last_serial")
+    shard = int(store.get_state("discovery_shard") or "0") % _DISCOVERY_SHARDS
+    all_packages: list[str] = []
+    last_serial = None
+    if not all_pypi_packages and shard != 0 and since_serial is not None:
+        last_serial = _get_last_serial(scheduler)
+        if last_serial is not None:
+            all_packages, _ = store.get_projects()
+    listing_cached = bool(all_packages)
+    if listing_cached:
+        _LOGGER.info("Using the cached list of all PyPI packages")
+    else:
+        _LOGGER.info("Getting list of all PyPI packages ... ")
+        all_packages, last_serial = _get_all_packages(scheduler, store)
     _LOGGER.info("Found %d packages", len(all_packages))
     packages_set = set(all_packages)
 
@@ -176,56 +718,99 @@ def update(packages: list[str], *, all_pypi_packages: bool = False) -> list[str]
     packages_set.update(name for name in etag_cache if etag_cache[name][1])
     packages_set.update(canonicalize_name(package) for package in packages)
 
-    _LOGGER.info("Updating cache for %d packages", len(packages_set))
+    # only packages changed since the last refresh need to be checked, along with the
+    # ones never checked, a full sweep is done without a recent enough refresh
+    changed = None
+    if all_pypi_packages:
+        _LOGGER.info("checking all PyPI packages, doing a full refresh")
+    elif last_serial is None or since_serial is None:
+        _LOGGER.info("no changelog serial, doing a full refresh")
+    elif int(last_serial) - int(since_serial) > _MAX_CHANGELOG_SERIALS:
+        _LOGGER.info("changelog serial %s is too old, doing a full refresh", since_serial)
+    else:
+        changed = _get_changed_packages(scheduler, int(since_serial), int(last_serial))
+    if changed is None:
+        to_update = packages_set
+    else:
+        if listing_cached:
+            all_packages = sorted(changed.union(all_packages))
+        else:
+            changed.intersection_update(set(all_packages) | packages_set | etag_cache.keys())
+        changed.update(json.loads(store.get_state("failed_packages") or "[]"))
+        to_update = changed | {name for name in packages_set if name not in etag_cache}
+        # outdated release records are fetched again whether they changed or not
+        outdated = store.get_outdated_packages(update_dataset.RELEASE_RECORD_VERSION)
+        if outdated:
+            _LOGGER.info("Fetching %d packages with outdated release records", len(outdated))
+        to_update.update(outdated)
+        packages_set.update(to_update)
+    if not all_pypi_packages:
+        # packages without manylinux wheels are checked once per cycle of shards
+        discovery = {
+            name for name in all_packages if zlib.crc32(name.encode()) % _DISCOVERY_SHARDS == shard
+        }
+        _LOGGER.info("Checking %d packages from discovery shard %d", len(discovery), shard)
+        to_update = to_update | discovery
+        packages_set.update(discovery)
+
+    skipped = to_update & resumed.keys()
+    for package in skipped:
+        outcome.apply(package, resumed[package])
+    to_update = to_update - skipped
+    if skipped:
+        _LOGGER.info("Skipping %d packages updated by the resumed run", len(skipped))
+
+    _LOGGER.info("Updating cache for %d packages", len(to_update))
 
-    _package_update_imap = functools.partial(_package_update, etag_cache)
+    _package_update_imap = functools.partial(_package_update, scheduler, api, etag_cache)
 
-    to_remove: set[str] = set()
-    to_add: set[str] = set()
     to_reprocess: set[str] = set()
+    journal = _Journal(store)
 
     try:
-        with ThreadPool(32) as pool:
+        with ThreadPool(max_concurrency) as pool:
             for package_status in pool.imap(
                 _package_update_imap,
-                sorted(packages_set),
+                sorted(to_update),
                 chunksize=1,
             ):
-                if package_status.etag is not None:
-                    new_etag_cache[package_status.name] = (
-                        package_status.etag,
-                        package_status.expect_cache,
-                    )
-                if package_status.status == Status.PROCESSED:
-                    pass
-                elif package_status.status == Status.REMOVED:
-                    to_remove.add(package_status.name)
-                    new_etag_cache[package_status.name] = ("", False)
-                else:
-                    assert package_status.status in {Status.MOVED, Status.ERROR}
+                if package_status.status in {Status.MOVED, Status.ERROR}:
                     to_reprocess.add(package_status.name)
-
-        for package in sorted(to_reprocess):
-            package_status = _package_update(new_etag_cache, package, handle_moved=True)
-            if package_status.etag is not None:
-                new_etag_cache[package_status.name] = (
-                    package_status.etag,
-                    package_status.expect_cache,
-                )
-            if package_status.status == Status.REMOVED:
-                to_remove.add(package_status.name)
-                new_etag_cache[package_status.name] = ("", False)
-            elif package_status.name != package:
-                to_remove.add(package)
-                new_etag_cache[package] = ("", False)
-                to_add.add(package_status.name)
+                else:
+                    outcome.apply(package_status.name, package_status)
+                    journal.append(package_status.name, package_status)
+
+            _package_update_imap = functools.partial(
+                _package_update,
+                scheduler,
+                api,
+                outcome.etag_cache.copy(),
+                handle_moved=True,
+            )
+            reprocess = sorted(to_reprocess)
+            for package, package_status in zip(
+                reprocess,
+                pool.imap(_package_update_imap, reprocess, chunksize=1),
+                strict=True,
+            ):
+                outcome.apply(package, package_status)
+                # failed packages are fetched again when resuming
+                if package_status.status != Status.ERROR:
+                    journal.append(package, package_status)
     finally:
-        with etag_cache_path.open("w") as f:
-            json.dump(new_etag_cache, f, sort_keys=True, indent=2)
+        journal.flush()
+    store.set_etags(outcome.etag_cache)
+    if not all_pypi_packages:
+        store.set_state("discovery_shard", str((shard + 1) % _DISCOVERY_SHARDS))
+    if last_serial is not None:
+        # failed packages are checked again by the next refresh
+        store.set_state("failed_packages", json.dumps(sorted(outcome.failed)))
+        store.set_state("last_serial", last_serial)
 
-    to_remove.update(name for name in new_etag_cache if not new_etag_cache[name][1])
+    etags = outcome.etag_cache
+    outcome.to_remove.update(name for name in etags if not etags[name][1])
 
-    result = sorted((packages_set - to_remove) | to_add)
+    result = sorted((packages_set - outcome.to_remove) | outcome.to_add)
 
     removed_packages = utils.load_removed_packages()
     for package in set(packages) - set(result):
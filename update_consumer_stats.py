@@ -1,22 +1,29 @@
+import collections
 import dataclasses
 import functools
+import hashlib
 import json
 import logging
 import multiprocessing
+import os
+import zipfile
 from datetime import UTC, date, datetime, timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
 from typing import Any, Final, cast
 
+import numpy as np
 import pandas as pd
 from packaging.utils import canonicalize_name
 from packaging.version import InvalidVersion, Version
 
+import release_store
 import update_dataset
 import utils
 
 TYPE_CHECKING = False
 if TYPE_CHECKING:
-    from collections.abc import Generator
-    from pathlib import Path
+    from collections.abc import Callable, Generator, Iterable
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -58,8 +65,48 @@ GLIBC_REMAP: Final[dict[str, str]] = {
 # reading the graphs without much added information
 GLIBC_NSW_MAX_VERSION: Final[Version] = Version("2.31")
 
+# bump this when the layout of the columnar consumer_data cache changes
+CONSUMER_CACHE_VERSION: Final[int] = 1
+# bump this when the layout of the aggregate caches or the way aggregates are computed changes
+CONSUMER_AGGREGATE_VERSION: Final[int] = 1
 
-def _get_major_minor(x: Any) -> str:
+# categories are fixed so that per-day dataframes keep the category dtype once concatenated
+PYTHON_VERSION_DTYPE: Final = pd.CategoricalDtype(list(PYTHON_EOL))
+PYTHON_VERSION2_DTYPE: Final = pd.CategoricalDtype(
+    [f"{version}{suffix}" for version in PYTHON_EOL for suffix in ("", "-nsw")],
+)
+GLIBC_VERSION_DTYPE: Final = pd.CategoricalDtype(
+    [
+        f"{version}{suffix}"
+        for version in ("0.0", *(glibc_versions[0] for glibc_versions in GLIBC_GROUPS))
+        for suffix in ("", "-nsw")
+    ],
+)
+# persisted aggregates are only valid for the exact same classification
+_AGGREGATE_SCHEMA: Final[str] = json.dumps(
+    [
+        CONSUMER_AGGREGATE_VERSION,
+        list(PYTHON_EOL),
+        GLIBC_REMAP,
+        str(GLIBC_NSW_MAX_VERSION),
+        utils.CONSUMER_WINDOW_SIZE.days,
+    ],
+)
+# bump this when the way the wheel support map is computed changes
+WHEEL_SUPPORT_MAP_VERSION: Final[int] = 1
+_WHEEL_SUPPORT_SCHEMA: Final[list[Any]] = [
+    WHEEL_SUPPORT_MAP_VERSION,
+    update_dataset.RELEASE_RECORD_VERSION,
+    list(PYTHON_EOL),
+]
+# days rolled at once past the first changed day, the aggregates of the window of a block
+# are held in memory along with it
+_ROLLING_BLOCK_SIZE: Final[timedelta] = timedelta(days=28)
+_AGGREGATE_COLUMNS: Final[list[str]] = ["day", "python_version", "python_version2", "glibc_version"]
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_major_minor(x: str) -> str:
     try:
         version = Version(x)
     except InvalidVersion:
@@ -69,11 +116,161 @@ def _get_major_minor(x: Any) -> str:
     return f"{version.major}.{version.minor}"
 
 
+@functools.lru_cache(maxsize=4096)
+def _get_glibc_version(x: str) -> str:
+    return GLIBC_REMAP.get(_get_major_minor(x), "0.0")
+
+
+@functools.lru_cache(maxsize=65536)
+def _get_project(x: str) -> str:
+    return str(canonicalize_name(x))
+
+
+def _convert_categorical(values: pd.Series, converter: Callable[[str], str]) -> pd.Categorical:
+    # only convert unique values, then broadcast the result using the codes
+    values_cat = pd.Categorical(values)
+    converted = np.array([converter(value) for value in values_cat.categories], dtype=object)
+    categories, codes = np.unique(converted, return_inverse=True)
+    return pd.Categorical.from_codes(codes[values_cat.codes], categories=categories)
+
+
+def _get_file_digest(file: Path) -> str:
+    with file.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _read_npz(cache_file: Path) -> dict[str, np.ndarray] | None:
+    if not cache_file.exists():
+        return None
+    try:
+        with np.load(cache_file) as data:
+            return {key: data[key] for key in data.files}
+    except (OSError, ValueError, zipfile.BadZipFile) as e:
+        _LOGGER.warning("ignoring invalid consumer cache %s: %s", cache_file, e)
+        return None
+
+
+def _write_npz(cache_file: Path, arrays: dict[str, Any]) -> None:
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    # workers may race on the same day, make the update atomic
+    temp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+    with temp_file.open("wb") as f:
+        np.savez_compressed(f, **arrays)
+    temp_file.replace(cache_file)
+
+
+def _get_source_key(file: Path) -> dict[str, np.ndarray]:
+    stat = file.stat()
+    return {
+        "source": np.array(file.name),
+        "source_size": np.array(stat.st_size),
+        "source_mtime_ns": np.array(stat.st_mtime_ns),
+        "source_digest": np.array(_get_file_digest(file)),
+    }
+
+
+def _is_source_valid(data: dict[str, np.ndarray], file: Path) -> bool:
+    if str(data["source"]) != file.name:
+        return False
+    stat = file.stat()
+    if int(data["source_size"]) != stat.st_size:
+        return False
+    # git checkouts do not preserve mtime, check the content before invalidating
+    return int(data["source_mtime_ns"]) == stat.st_mtime_ns or str(
+        data["source_digest"],
+    ) == _get_file_digest(file)
+
+
+def _frame_to_arrays(df: pd.DataFrame) -> dict[str, np.ndarray]:
+    arrays = {"columns": np.array(list(df.columns))}
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            arrays[f"{column}_codes"] = df[column].cat.codes.to_numpy()
+            arrays[f"{column}_categories"] = df[column].cat.categories.to_numpy(dtype=str)
+        else:
+            arrays[column] = df[column].to_numpy()
+    return arrays
+
+
+def _frame_from_arrays(data: dict[str, np.ndarray]) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            column: pd.Categorical.from_codes(
+                data[f"{column}_codes"],
+                categories=data[f"{column}_categories"],
+            )
+            if f"{column}_codes" in data
+            else data[column]
+            for column in map(str, data["columns"])
+        },
+    )
+
+
+def _read_consumer_file(file: Path, date_: date, usecols: list[str]) -> pd.DataFrame:
+    # raw string columns are read as categoricals, this is what gets cached
+    cache_file = utils.get_consumer_cache_path(date_)
+    data = _read_npz(cache_file)
+    if (
+        data is not None
+        and data.get("version") == CONSUMER_CACHE_VERSION
+        and set(map(str, data["columns"])) == set(usecols)
+        and _is_source_valid(data, file)
+    ):
+        return _frame_from_arrays(data)
+    df = pd.read_csv(
+        file,
+        usecols=usecols,
+        dtype={column: "category" for column in usecols if column != "num_downloads"},
+        na_filter=False,
+    )
+    _write_npz(
+        cache_file,
+        {
+            "version": np.array(CONSUMER_CACHE_VERSION),
+            **_get_source_key(file),
+            **_frame_to_arrays(df),
+        },
+    )
+    return df
+
+
+def _get_support_digest(cutoffs: np.ndarray, date_: date) -> str:
+    # only the classification on that day matters, not the cutoff dates themselves
+    return hashlib.sha256(np.packbits(cutoffs <= date_.toordinal()).tobytes()).hexdigest()
+
+
+def _add_nsw_suffix(values: pd.Series, mask: np.ndarray) -> pd.Categorical:
+    # "-nsw": no supported wheel
+    values_cat = pd.Categorical(values)
+    categories = list(values_cat.categories)
+    return pd.Categorical.from_codes(
+        values_cat.codes + mask * len(categories),
+        categories=[*categories, *(f"{value}-nsw" for value in categories)],
+    )
+
+
+def _read_consumer_aggregate(
+    wheel_support_map: WheelSupportMap,
+    file: Path,
+    date_: date,
+) -> tuple[pd.DataFrame, str] | None:
+    data = _read_npz(utils.get_consumer_aggregate_path(date_))
+    if data is None or data.get("schema") != _AGGREGATE_SCHEMA or not _is_source_valid(data, file):
+        return None
+    cutoffs = wheel_support_map.get_cutoffs(data["projects"], warn=False)
+    support_digest = _get_support_digest(cutoffs, date_)
+    if support_digest != str(data["support_digest"]):
+        return None
+    df = _frame_from_arrays(data)
+    df.insert(0, "day", pd.to_datetime(date_))
+    return df, f"{data['source_digest']}:{support_digest}"
+
+
 def _load_df(
-    wheel_support_map: dict[str, dict[str, date]],
+    wheel_support_map: WheelSupportMap,
     path: Path,
     date_: date,
-) -> pd.DataFrame | None:
+) -> tuple[pd.DataFrame, str] | None:
     folder = path / date_.strftime("%Y") / date_.strftime("%m")
     file = folder / f"{date_.strftime('%d')}.csv"
     file_xz = file.with_suffix(".csv.xz")
@@ -83,51 +280,67 @@ def _load_df(
         file = file_xz
     if not file.exists():
         return None
-    df = pd.read_csv(
-        file,
-        converters={
-            "python_version": _get_major_minor,
-            "glibc_version": lambda x: GLIBC_REMAP.get(_get_major_minor(x), "0.0"),
-            "project": lambda x: str(canonicalize_name(x)),
-        },
-        usecols=usecols,
-    )
+    aggregate = _read_consumer_aggregate(wheel_support_map, file, date_)
+    if aggregate is not None:
+        df, digest = aggregate
+        return df.astype(
+            {
+                "python_version": PYTHON_VERSION_DTYPE,
+                "python_version2": PYTHON_VERSION2_DTYPE,
+                "glibc_version": GLIBC_VERSION_DTYPE,
+            },
+        ), digest
+
+    df = _read_consumer_file(file, date_, usecols)
+    df["python_version"] = _convert_categorical(df["python_version"], _get_major_minor)
+    df["glibc_version"] = _convert_categorical(df["glibc_version"], _get_glibc_version)
+    if "project" in usecols:
+        df["project"] = _convert_categorical(df["project"], _get_project)
     df["day"] = pd.to_datetime(date_)
     # remove unneeded python version
     df.query("python_version in @PYTHON_EOL", inplace=True)
     # check if the package is supported or not for a given python version
+    projects = pd.Categorical(df["project"] if "project" in usecols else [])
+    projects = projects.remove_unused_categories()
+    cutoffs = wheel_support_map.get_cutoffs(projects.categories.to_numpy(dtype=str))
+    support_digest = _get_support_digest(cutoffs, date_)
     if "project" in usecols:
-
-        def _get_supported_wheel(row: Any, *, src_column: str) -> str:
-            value = row[src_column]
-            assert isinstance(value, str)
-            if src_column == "glibc_version" and Version(value) >= GLIBC_NSW_MAX_VERSION:
-                return value
-            project = wheel_support_map.get(row["project"])
-            if project is None:
-                _LOGGER.warning("%r not found in wheel_support_map", row["project"])
-                return value
-            max_date = project[row["python_version"]]
-            if date_ < max_date:
-                return value
-            if row["python_version"] == "3.12":
-                return f"{value}-nsw"  # no supported wheel
-            return f"{value}-nsw"  # no supported wheel
-
-        df["python_version2"] = df.apply(_get_supported_wheel, axis=1, src_column="python_version")
-        df["glibc_version"] = df.apply(_get_supported_wheel, axis=1, src_column="glibc_version")
-
-        df = (
-            df.drop(["project"], axis=1)
-            .groupby(
-                ["day", "python_version", "python_version2", "glibc_version"],
-                as_index=False,
-            )
-            .aggregate("sum")
+        python_codes = pd.Categorical(df["python_version"], categories=list(PYTHON_EOL)).codes
+        nsw = cutoffs[projects.codes, python_codes] <= date_.toordinal()
+        df["python_version2"] = _add_nsw_suffix(df["python_version"], nsw)
+        glibc_versions = pd.Categorical(df["glibc_version"])
+        glibc_nsw = np.array(
+            [Version(value) < GLIBC_NSW_MAX_VERSION for value in glibc_versions.categories],
+            dtype=bool,
         )
+        nsw &= glibc_nsw[glibc_versions.codes]
+        df["glibc_version"] = _add_nsw_suffix(df["glibc_version"], nsw)
+        df = df.drop(["project"], axis=1)
     else:
         df["python_version2"] = df["python_version"]
-    return df
+    df = (
+        df.astype(
+            {
+                "python_version": PYTHON_VERSION_DTYPE,
+                "python_version2": PYTHON_VERSION2_DTYPE,
+                "glibc_version": GLIBC_VERSION_DTYPE,
+            },
+        )
+        .groupby(_AGGREGATE_COLUMNS, as_index=False, observed=True)
+        .aggregate("sum")
+    )
+    source_key = _get_source_key(file)
+    _write_npz(
+        utils.get_consumer_aggregate_path(date_),
+        {
+            "schema": np.array(_AGGREGATE_SCHEMA),
+            **source_key,
+            "support_digest": np.array(support_digest),
+            "projects": projects.categories.to_numpy(dtype=str),
+            **_frame_to_arrays(df.drop(["day"], axis=1)),
+        },
+    )
+    return df, f"{source_key['source_digest']}:{support_digest}"
 
 
 @dataclasses.dataclass
@@ -136,92 +349,179 @@ class SupportDates:
     not_supported: list[date] = dataclasses.field(default_factory=list)
 
 
-def _build_wheel_support_map(packages: list[str]) -> dict[str, dict[str, date]]:
+@dataclasses.dataclass(frozen=True)
+class WheelSupportMap:
+    # sorted project names and the matching (project x python) table of the
+    # date ordinal from which no supported wheel exists
+    projects: np.ndarray
+    cutoffs: np.ndarray
+
+    @classmethod
+    def from_dict(cls, wheel_support_map: dict[str, dict[str, date]]) -> WheelSupportMap:
+        projects = sorted(wheel_support_map)
+        cutoffs = np.array(
+            [
+                [wheel_support_map[project][version].toordinal() for version in PYTHON_EOL]
+                for project in projects
+            ],
+            dtype=np.int32,
+        ).reshape(-1, len(PYTHON_EOL))
+        return cls(np.array(projects, dtype=str), cutoffs)
+
+    @classmethod
+    def load(cls, path: Path) -> WheelSupportMap:
+        return cls(
+            np.load(path / "projects.npy", mmap_mode="r"),
+            np.load(path / "cutoffs.npy", mmap_mode="r"),
+        )
+
+    def save(self, path: Path) -> None:
+        np.save(path / "projects.npy", self.projects)
+        np.save(path / "cutoffs.npy", self.cutoffs)
+
+    def get_cutoffs(self, projects: np.ndarray, *, warn: bool = True) -> np.ndarray:
+        result = np.full((len(projects), len(PYTHON_EOL)), date.max.toordinal(), dtype=np.int32)
+        if len(self.projects) == 0 or len(projects) == 0:
+            return result
+        index = np.minimum(np.searchsorted(self.projects, projects), len(self.projects) - 1)
+        found = self.projects[index] == projects
+        result[found] = self.cutoffs[index[found]]
+        if warn:
+            for project in projects[~found]:
+                _LOGGER.warning("%r not found in wheel_support_map", str(project))
+        return result
+
+
+# wheel support map of pool workers, memory-mapped from the files published by update
+_worker_wheel_support_map: WheelSupportMap | None = None
+
+
+def _init_worker(wheel_support_map_path: Path) -> None:
+    global _worker_wheel_support_map  # noqa: PLW0603
+    _worker_wheel_support_map = WheelSupportMap.load(wheel_support_map_path)
+
+
+def _load_df_worker(path: Path, date_: date) -> tuple[pd.DataFrame, str] | None:
+    assert _worker_wheel_support_map is not None
+    return _load_df(_worker_wheel_support_map, path, date_)
+
+
+def _build_package_support(
+    package: str,
+    releases: list[update_dataset.Release],
+) -> dict[str, date]:
+    package_result: dict[str, SupportDates] = {version: SupportDates() for version in PYTHON_EOL}
+    only_prerelease = not any(release.prerelease is False for release in releases)
+    for release in releases:
+        if release.prerelease and not only_prerelease:
+            _LOGGER.debug('"%s": ignore pre-release %s', package, release.version)
+            continue
+        upload_date, pythons_str = release.upload_date, release.python
+        if not pythons_str:
+            continue
+        pythons = pythons_str.split(".")
+        pythons = list(filter(lambda x: not x.startswith("py2"), pythons))
+        if not pythons:
+            continue
+        if pythons[0] == "abi3":
+            del pythons[0]  # remove the tag & replace with supported versions
+            cp3_start = next(python for python in pythons if python.startswith("cp3"))
+            start_minor = int(cp3_start[3:])
+            for key in PYTHON_EOL:
+                key_minor = int(key[2:])
+                if key_minor > start_minor:
+                    pythons.append(f"cp3{key_minor}")
+        if any(python.startswith("py3") for python in pythons):
+            py3_start = next(python for python in pythons if python.startswith("py3"))
+            start_minor = int(py3_start[3:])
+            for key in PYTHON_EOL:
+                key_minor = int(key[2:])
+                if key_minor > start_minor:
+                    pythons.append(f"py3{key_minor}")
+        supported_set = {f"{python[2]}.{python[3:]}" for python in pythons}
+        for key in PYTHON_EOL:
+            if key in supported_set:
+                package_result[key].supported = max(package_result[key].supported, upload_date)
+            else:
+                package_result[key].not_supported.append(upload_date)
+    result: dict[str, date] = {}
+    previous_date = date.min
+    for key in PYTHON_EOL:
+        if package_result[key].supported == date.min:
+            if len(package_result[key].not_supported) == 0:
+                if package not in {
+                    "carbonara-pyvex",
+                    "libaio-bins",
+                    "ms-ivy",
+                    "nighres",
+                    "oneqloud-polynomials",
+                    "sciunit2",
+                    "simuvex",
+                    "tesseract-python",
+                }:
+                    _LOGGER.warning("%r: assume python %s supported", package, key)
+                result[key] = date.max
+            else:
+                result[key] = min(package_result[key].not_supported)
+        else:
+            package_result[key].not_supported.append(date.max)
+            result[key] = min(
+                filter(
+                    lambda x: x > package_result[key].supported,
+                    package_result[key].not_supported,
+                ),
+            )
+        result[key] = previous_date = max(previous_date, result[key])
+    return result
+
+
+def _load_wheel_support_cache() -> dict[str, tuple[str, dict[str, date]]]:
+    data = utils.load_json_cache(utils.WHEEL_SUPPORT_MAP_PATH, _WHEEL_SUPPORT_SCHEMA)
+    return {
+        package: (etag, dict(zip(PYTHON_EOL, map(date.fromisoformat, dates), strict=True)))
+        for package, (etag, dates) in data.items()
+    }
+
+
+def _save_wheel_support_cache(cache: dict[str, tuple[str, dict[str, date]]]) -> None:
+    packages = {
+        package: (etag, [support[key].isoformat() for key in PYTHON_EOL])
+        for package, (etag, support) in sorted(cache.items())
+    }
+    utils.save_json_cache(utils.WHEEL_SUPPORT_MAP_PATH, _WHEEL_SUPPORT_SCHEMA, packages)
+
+
+def _build_wheel_support_map(packages: list[str]) -> WheelSupportMap:
     _LOGGER.info("building wheel support map")
+    store = release_store.get_store()
+    etag_cache = store.get_etags()
+    stored_packages = set(store.get_packages())
+    # the support map of a package only depends on its cache entry, identified by its etag
+    support_cache = _load_wheel_support_cache()
+    new_support_cache: dict[str, tuple[str, dict[str, date]]] = {}
     result: dict[str, dict[str, date]] = {}
+    rebuilt = 0
     for package in packages:
-        cache_file = utils.get_release_cache_path(package)
-        if not cache_file.exists():
+        if package not in stored_packages:
             result[package] = dict.fromkeys(PYTHON_EOL, date.max)
             continue
-        info = json.loads(cache_file.read_text())
-        package_result: dict[str, SupportDates] = {
-            version: SupportDates() for version in PYTHON_EOL
-        }
-        only_prerelease = True
-        for release in info["releases"]:
-            try:
-                version_pep = Version(release)
-                if not version_pep.is_prerelease:
-                    only_prerelease = False
-                    break
-            except InvalidVersion as e:
-                _LOGGER.warning('"%s": %s', package, e)
-        for release, release_files in info["releases"].items():
-            try:
-                version_pep = Version(release)
-                if version_pep.is_prerelease and not only_prerelease:
-                    _LOGGER.debug('"%s": ignore pre-release %s', package, release)
-                    continue
-            except InvalidVersion:
-                pass
-            # check if file could be installed
-            upload_date, pythons_str, _ = update_dataset.parse_version(release_files)
-            if not pythons_str:
-                continue
-            pythons = pythons_str.split(".")
-            pythons = list(filter(lambda x: not x.startswith("py2"), pythons))
-            if not pythons:
+        etag = etag_cache.get(package, ("", False))[0]
+        cached = support_cache.get(package)
+        if etag and cached is not None and cached[0] == etag:
+            result[package] = cached[1]
+        else:
+            releases = update_dataset.get_releases(package)
+            if releases is None:
+                # unreadable release records (outdated schema) are handled as not stored
+                result[package] = dict.fromkeys(PYTHON_EOL, date.max)
                 continue
-            if pythons[0] == "abi3":
-                del pythons[0]  # remove the tag & replace with supported versions
-                cp3_start = next(python for python in pythons if python.startswith("cp3"))
-                start_minor = int(cp3_start[3:])
-                for key in PYTHON_EOL:
-                    key_minor = int(key[2:])
-                    if key_minor > start_minor:
-                        pythons.append(f"cp3{key_minor}")
-            if any(python.startswith("py3") for python in pythons):
-                py3_start = next(python for python in pythons if python.startswith("py3"))
-                start_minor = int(py3_start[3:])
-                for key in PYTHON_EOL:
-                    key_minor = int(key[2:])
-                    if key_minor > start_minor:
-                        pythons.append(f"py3{key_minor}")
-            supported_set = {f"{python[2]}.{python[3:]}" for python in pythons}
-            for key in PYTHON_EOL:
-                if key in supported_set:
-                    package_result[key].supported = max(package_result[key].supported, upload_date)
-                else:
-                    package_result[key].not_supported.append(upload_date)
-        result[package] = {}
-        previous_date = date.min
-        for key in PYTHON_EOL:
-            if package_result[key].supported == date.min:
-                if len(package_result[key].not_supported) == 0:
-                    if package not in {
-                        "carbonara-pyvex",
-                        "libaio-bins",
-                        "ms-ivy",
-                        "nighres",
-                        "oneqloud-polynomials",
-                        "sciunit2",
-                        "simuvex",
-                        "tesseract-python",
-                    }:
-                        _LOGGER.warning("%r: assume python %s supported", package, key)
-                    result[package][key] = date.max
-                else:
-                    result[package][key] = min(package_result[key].not_supported)
-            else:
-                package_result[key].not_supported.append(date.max)
-                result[package][key] = min(
-                    filter(
-                        lambda x: x > package_result[key].supported,
-                        package_result[key].not_supported,
-                    ),
-                )
-            result[package][key] = previous_date = max(previous_date, result[package][key])
+            result[package] = _build_package_support(package, releases)
+            rebuilt += 1
+        if etag:
+            new_support_cache[package] = (etag, result[package])
+    _LOGGER.info("rebuilt wheel support for %d packages out of %d", rebuilt, len(packages))
+    update_dataset.log_cache_info()
+    _save_wheel_support_cache(new_support_cache)
 
     removed_packages: Final = utils.load_removed_packages()
     for package, removed_date in removed_packages.items():
@@ -232,7 +532,29 @@ def _build_wheel_support_map(packages: list[str]) -> dict[str, dict[str, date]]:
         for key in PYTHON_EOL:
             result[package][key] = removed_date
 
-    return result
+    return WheelSupportMap.from_dict(result)
+
+
+def _get_stats_matrix(
+    df: pd.DataFrame,
+    column: str,
+    index: pd.DatetimeIndex,
+    keys: list[str],
+    *,
+    decimals: int,
+) -> np.ndarray:
+    # dense (day x key) matrix of the download share of each key, in percent
+    downloads = df.groupby(["day", column], observed=True)["num_downloads"].sum()
+    stats = downloads / downloads.groupby(level="day").sum()
+    missing = downloads.unstack(column).reindex(index=index, columns=keys).isna().to_numpy()
+    values = stats.unstack(column).reindex(index=index, columns=keys).to_numpy(dtype=float)
+    return cast("np.ndarray", np.round(100.0 * np.where(missing, 0.0, values), decimals))
+
+
+def _get_stats_series(keys: list[str], matrix: np.ndarray) -> dict[str, list[str] | list[float]]:
+    series: dict[str, list[str] | list[float]] = {"keys": keys}
+    series.update(zip(keys, matrix.T.tolist(), strict=True))
+    return series
 
 
 def date_iterator(start: date, end: date) -> Generator[date]:
@@ -242,44 +564,185 @@ def date_iterator(start: date, end: date) -> Generator[date]:
         date_ = date_ + timedelta(days=1)
 
 
+def _apply_rolling_window(df: pd.DataFrame) -> pd.DataFrame:
+    # the window is computed on the sparse long-format aggregate, per combination:
+    # sums are constant between an entry and the next one of the same combination
+    # (or the end of its window), only those days are emitted, each once
+    columns = ["python_version", "python_version2", "glibc_version"]
+    df = df.groupby([*columns, "day"], observed=True)["num_downloads"].sum().reset_index()
+    if df.empty:
+        return df[["day", *columns, "num_downloads"]]
+    unique_days, inverse = np.unique(df["day"].to_numpy(), return_inverse=True)
+    present_days = unique_days.astype("datetime64[D]").astype(np.int64)
+    entry_days = present_days[inverse]
+    window = utils.CONSUMER_WINDOW_SIZE.days
+    codes = np.stack([df[column].cat.codes.to_numpy() for column in columns])
+    new_combination = np.ones(len(df), dtype=bool)
+    new_combination[1:] = (codes[:, 1:] != codes[:, :-1]).any(axis=0)
+    combinations = np.cumsum(new_combination)
+
+    # days covered by each entry: [day, min(next day of the combination, day + window))
+    next_days = np.full(len(df), np.iinfo(np.int64).max)
+    next_days[:-1] = np.where(new_combination[1:], next_days[:-1], entry_days[1:])
+    first = np.searchsorted(present_days, entry_days)
+    counts = np.searchsorted(present_days, np.minimum(next_days, entry_days + window)) - first
+    entries = np.repeat(np.arange(len(df)), counts)
+    day_indices = (
+        first[entries] + np.arange(len(entries)) - np.repeat(np.cumsum(counts) - counts, counts)
+    )
+    days = present_days[day_indices]
+
+    # window sum is the cumulative sum up to the entry minus the one up to the last
+    # entry of the same combination that fell out of the window
+    offset = window - int(present_days[0])
+    stride = int(present_days[-1]) + offset + 1
+    keys = combinations * stride + entry_days + offset
+    previous = np.searchsorted(
+        keys,
+        combinations[entries] * stride + days - window + offset,
+        side="right",
+    )
+    totals = np.concatenate(([0], np.cumsum(df["num_downloads"].to_numpy(dtype=np.int64))))
+    num_downloads = (totals[entries + 1] - totals[previous]).astype(np.float64)
+
+    result = pd.DataFrame(
+        {
+            "day": unique_days[day_indices],
+            **{column: df[column].array.take(entries) for column in columns},
+            "num_downloads": num_downloads,
+        },
+    )
+    result = result[result["num_downloads"] > 0]
+    return result.sort_values(["day", *columns], ignore_index=True)
+
+
+def _get_rolling_downloads(
+    results: Iterable[tuple[date, tuple[pd.DataFrame, str] | None]],
+    start: date,
+    end: date,
+) -> pd.DataFrame:
+    # rolled downloads of a day only depend on the aggregates within its window,
+    # reuse the persisted ones up to the first day whose aggregate changed
+    stored_digests: dict[date, str] | None = None
+    stored_df = None
+    data = _read_npz(utils.CONSUMER_ROLLING_PATH)
+    if (
+        data is not None
+        and data.get("schema") == _AGGREGATE_SCHEMA
+        and date.fromordinal(int(data["start"])) <= start
+    ):
+        stored_digests = dict(
+            zip(
+                map(date.fromordinal, data["days"].tolist()),
+                data["digests"].tolist(),
+                strict=True,
+            ),
+        )
+        stored_df = _frame_from_arrays(data)
+
+    # results are streamed in day order, from the first changed day on, days are rolled in
+    # blocks as soon as their windows are loaded, only the aggregates that can still be
+    # part of the window of a day not rolled yet are kept
+    digests: dict[date, str] = {}
+    inputs: collections.deque[tuple[date, pd.DataFrame]] = collections.deque()
+    recompute_start: date | None = None
+    roll_start: date | None = None
+    rolled: list[pd.DataFrame] = []
+    for day, result in results:
+        if result is not None:
+            df, digests[day] = result
+            inputs.append((day, df))
+        if recompute_start is None and (
+            stored_digests is None or digests.get(day) != stored_digests.get(day)
+        ):
+            recompute_start = roll_start = max(start, day)
+        if (
+            roll_start is not None
+            and roll_start <= day
+            and (day == end or day - roll_start >= _ROLLING_BLOCK_SIZE)
+        ):
+            if inputs:
+                df = _apply_rolling_window(pd.concat(df for _, df in inputs))
+                rolled.append(df[df["day"] >= pd.to_datetime(roll_start)])
+            roll_start = day + timedelta(days=1)
+        first_needed = roll_start or max(start, day + timedelta(days=1))
+        while inputs and inputs[0][0] <= first_needed - utils.CONSUMER_WINDOW_SIZE:
+            inputs.popleft()
+    if recompute_start is None:
+        recompute_start = end + timedelta(days=1)
+    _LOGGER.info("applied rolling window from %s", recompute_start)
+
+    dataframes = []
+    if stored_df is not None:
+        dataframes.append(
+            stored_df[
+                (stored_df["day"] >= pd.to_datetime(start))
+                & (stored_df["day"] < pd.to_datetime(recompute_start))
+            ],
+        )
+    dataframes.extend(rolled)
+    df = pd.concat(dataframes).astype(
+        {
+            "python_version": PYTHON_VERSION_DTYPE,
+            "python_version2": PYTHON_VERSION2_DTYPE,
+            "glibc_version": GLIBC_VERSION_DTYPE,
+        },
+    )
+
+    days = sorted(digests)
+    _write_npz(
+        utils.CONSUMER_ROLLING_PATH,
+        {
+            "schema": np.array(_AGGREGATE_SCHEMA),
+            "start": np.array(start.toordinal()),
+            "days": np.array([day.toordinal() for day in days], dtype=np.int64),
+            "digests": np.array([digests[day] for day in days], dtype=str),
+            **_frame_to_arrays(df),
+        },
+    )
+    return df
+
+
+def _prune_day_caches(first_day: date) -> None:
+    # the day caches are persisted, the ones before the first day read are deleted so that
+    # they don't grow forever
+    pruned = 0
+    for cache_path in (utils.CONSUMER_CACHE_PATH, utils.CONSUMER_AGGREGATE_PATH):
+        for cache_file in cache_path.glob("*/*/*.npz"):
+            try:
+                day = date(
+                    int(cache_file.parent.parent.name),
+                    int(cache_file.parent.name),
+                    int(cache_file.stem),
+                )
+            except ValueError:
+                continue
+            if day < first_day:
+                cache_file.unlink()
+                pruned += 1
+        for directory in [*cache_path.glob("*/*"), *cache_path.glob("*")]:
+            if directory.is_dir() and not any(directory.iterdir()):
+                directory.rmdir()
+    _LOGGER.info("pruned %d day caches before %s", pruned, first_day)
+
+
 def update(packages: list[str], path: Path, start: date, end: date) -> None:
     wheel_support_map = _build_wheel_support_map(packages)
 
     _LOGGER.info("loading data")
-    with multiprocessing.Pool() as pool:
-        _load_df_partial = functools.partial(_load_df, wheel_support_map, path)
-        dataframes = pool.map(
-            _load_df_partial,
-            date_iterator(start - utils.CONSUMER_WINDOW_SIZE, end),
-            chunksize=7,
-        )
-    dataframes = list(filter(lambda x: x is not None, dataframes))
-    df = pd.concat(dataframes)
+    days = list(date_iterator(start - utils.CONSUMER_WINDOW_SIZE, end))
+    with TemporaryDirectory() as temp:
+        # workers memory-map the published map rather than getting a pickled copy
+        wheel_support_map.save(Path(temp))
+        with multiprocessing.Pool(initializer=_init_worker, initargs=(Path(temp),)) as pool:
+            _load_df_partial = functools.partial(_load_df_worker, path)
+            # consume days as they are loaded rather than collecting all of them first
+            results = pool.imap(_load_df_partial, days, chunksize=7)
+            df = _get_rolling_downloads(zip(days, results, strict=True), start, end)
 
     _LOGGER.info("computing statistics")
 
-    df = df.groupby(
-        ["day", "python_version", "python_version2", "glibc_version"],
-        as_index=False,
-    ).aggregate("sum")
-
-    # apply rolling window
-    df = pd.pivot_table(
-        df,
-        index="day",
-        columns=["python_version", "python_version2", "glibc_version"],
-        values="num_downloads",
-        fill_value=0,
-        aggfunc="sum",
-    )
-    df = df.rolling(window=utils.CONSUMER_WINDOW_SIZE, min_periods=1).sum()
-    df = df.stack(list(range(df.columns.nlevels)), future_stack=True).reset_index().fillna(0.0)
-    df.rename(columns={0: "num_downloads"}, inplace=True)
-    df = df[(df["num_downloads"] > 0) & (df["day"] >= pd.to_datetime(start))]
-    df = df.groupby(
-        ["day", "python_version", "python_version2", "glibc_version"],
-        as_index=False,
-    ).aggregate("sum")
+    df = df.groupby(_AGGREGATE_COLUMNS, as_index=False).aggregate("sum")
 
     # non EOL dataframe
     df_non_eol = df.copy()
@@ -287,184 +750,87 @@ def update(packages: list[str], path: Path, start: date, end: date) -> None:
         mask = (df_non_eol["python_version"] == k) & (df_non_eol["day"] >= v)
         df_non_eol.loc[mask, "num_downloads"] = 0
 
-    df.set_index("day", append=True, inplace=True)
-    df = df.swaplevel()
-
-    df_non_eol.set_index("day", append=True, inplace=True)
-    df_non_eol = df_non_eol.swaplevel()
-
-    # python version download stats
-    df_python = (
-        df[["python_version2", "num_downloads"]]
-        .groupby(["day", "python_version2"])
-        .aggregate("sum")
-    )
-    df_python_all = df_python.groupby(["day"]).aggregate("sum")
-    df_python_stats = df_python / df_python_all
-
-    df_python_non_eol = (
-        df_non_eol[["python_version2", "num_downloads"]]
-        .groupby(["day", "python_version2"])
-        .aggregate("sum")
-    )
-    df_python_non_eol_all = df_python_non_eol.groupby(["day"]).aggregate("sum")
-    df_python_non_eol_stats = df_python_non_eol / df_python_non_eol_all
-
-    # glibc version download stats
-    df_glibc = (
-        df[["glibc_version", "num_downloads"]].groupby(["day", "glibc_version"]).aggregate("sum")
-    )
-    df_glibc_all = df_glibc.groupby(["day"]).aggregate("sum")
-    df_glibc_stats = df_glibc / df_glibc_all
-
-    df_glibc_non_eol = (
-        df_non_eol[["glibc_version", "num_downloads"]]
-        .groupby(["day", "glibc_version"])
-        .aggregate("sum")
-    )
-    df_glibc_non_eol_all = df_glibc_non_eol.groupby(["day"]).aggregate("sum")
-    df_glibc_non_eol_stats = df_glibc_non_eol / df_glibc_non_eol_all
-
+    index = pd.DatetimeIndex(df["day"].unique()).sort_values()
     out: dict[str, Any] = {
         "last_update": datetime.now(UTC).strftime("%A, %d %B %Y, %H:%M:%S %Z"),
-        "index": [d.date().isoformat() for d in df_python_all.index],
+        "index": [d.date().isoformat() for d in index],
     }
 
     glibc_versions = [x[0] for x in GLIBC_GROUPS[::-1]]
-    glibc_version = dict[str, list[str] | list[float]]()
-    glibc_version["keys"] = [
+    glibc_keys = [
         f"{v}{suffix}"
         for v in glibc_versions
         for suffix in ("", "-nsw")
         if suffix != "-nsw" or Version(v) < GLIBC_NSW_MAX_VERSION
     ]
-    glibc_version_non_eol = dict[str, list[str] | list[float]]()
-    glibc_version_non_eol["keys"] = glibc_version["keys"]
-    for version in glibc_versions:
-        for suffix in ("", "-nsw"):
-            if suffix == "-nsw" and Version(version) >= GLIBC_NSW_MAX_VERSION:
-                continue
-            version_suffix = f"{version}{suffix}"
-            stats = []
-            stats_non_eol = []
-            for day in out["index"]:
-                try:
-                    value = float(
-                        df_glibc_stats.loc[(pd.to_datetime(day), version_suffix), "num_downloads"],
-                    )
-                except KeyError:
-                    value = 0.0
-                try:
-                    value_non_eol = float(
-                        df_glibc_non_eol_stats.loc[
-                            (pd.to_datetime(day), version_suffix),
-                            "num_downloads",
-                        ],
-                    )
-                except KeyError:
-                    value_non_eol = 0.0
-                stats.append(float(f"{100.0 * value:.2f}"))
-                stats_non_eol.append(float(f"{100.0 * value_non_eol:.2f}"))
-            glibc_version[f"{version}{suffix}"] = stats
-            glibc_version_non_eol[f"{version}{suffix}"] = stats_non_eol
-
-    out["glibc_version"] = glibc_version
-    out["glibc_version_non_eol"] = glibc_version_non_eol
-
-    python_versions = [f"{v}{suffix}" for v in PYTHON_EOL for suffix in ("-nsw", "")]
-    python_version = dict[str, list[str] | list[float]]()
-    python_version_non_eol = dict[str, list[str] | list[float]]()
-    glibc_readiness = dict[str, dict[str, list[str] | list[float]]]()
-    python_version["keys"] = python_versions
-    python_version_non_eol["keys"] = [
-        version
-        for version in python_versions
-        if PYTHON_EOL[version.split("-")[0]] > pd.to_datetime(start)
+    out["glibc_version"] = _get_stats_series(
+        glibc_keys,
+        _get_stats_matrix(df, "glibc_version", index, glibc_keys, decimals=2),
+    )
+    out["glibc_version_non_eol"] = _get_stats_series(
+        glibc_keys,
+        _get_stats_matrix(df_non_eol, "glibc_version", index, glibc_keys, decimals=2),
+    )
+
+    python_keys = [f"{v}{suffix}" for v in PYTHON_EOL for suffix in ("-nsw", "")]
+    python_keys_non_eol = [
+        key for key in python_keys if PYTHON_EOL[key.split("-")[0]] > pd.to_datetime(start)
     ]
-    for version in python_versions:
-        stats = []
-        for day in out["index"]:
-            try:
-                value = float(df_python_stats.loc[(pd.to_datetime(day), version), "num_downloads"])
-            except KeyError:
-                value = 0.0
-            stats.append(float(f"{100.0 * value:.1f}"))
-        python_version[version] = stats
-        if version in python_version_non_eol["keys"]:
-            stats = []
-            for day in out["index"]:
-                try:
-                    value = float(
-                        df_python_non_eol_stats.loc[
-                            (pd.to_datetime(day), version),
-                            "num_downloads",
-                        ],
-                    )
-                except KeyError:
-                    value = 0.0
-                stats.append(float(f"{100.0 * value:.1f}"))
-            python_version_non_eol[version] = stats
-
-        if version.endswith("-nsw"):
-            continue
+    python_matrix = _get_stats_matrix(df, "python_version2", index, python_keys, decimals=1)
+    python_matrix_non_eol = _get_stats_matrix(
+        df_non_eol,
+        "python_version2",
+        index,
+        python_keys_non_eol,
+        decimals=1,
+    )
 
-        df_python_version = df[df["python_version"] == version]
-        df_glibc = (
-            df_python_version[["glibc_version", "num_downloads"]]
-            .groupby(["day", "glibc_version"])
-            .aggregate("sum")
-        )
-        df_glibc_all = df_glibc.groupby(["day"]).aggregate("sum")
-        df_glibc_stats = df_glibc / df_glibc_all
-        glibc_readiness_ver = dict[str, list[str] | list[float]]()
-        glibc_readiness_ver["keys"] = cast("list[str]", list(glibc_version["keys"]))
-        glibc_readiness[version] = glibc_readiness_ver
-        for version_ in glibc_versions:
-            for suffix in ("", "-nsw"):
-                if suffix == "-nsw" and Version(version_) >= GLIBC_NSW_MAX_VERSION:
-                    continue
-                version_suffix = f"{version_}{suffix}"
-                stats = []
-                for day in out["index"]:
-                    try:
-                        value = float(
-                            df_glibc_stats.loc[
-                                (pd.to_datetime(day), version_suffix),
-                                "num_downloads",
-                            ],
-                        )
-                    except KeyError:
-                        value = 0.0
-                    stats.append(float(f"{100.0 * value:.2f}"))
-                glibc_readiness_ver[f"{version_}{suffix}"] = stats
     # remove all zeros "-nsw" entries
-    for key in list(python_version["keys"]):
-        assert isinstance(key, str)
-        if not key.endswith("-nsw"):
-            continue
-        if all(value == 0.0 for value in python_version[key]):
-            python_version["keys"].remove(key)  # type: ignore[arg-type]
-            python_version.pop(key)
-            glibc_readiness_ver = glibc_readiness[key.rstrip("-nsw")]
-            for glibc_key in list(glibc_readiness_ver["keys"]):
-                assert isinstance(glibc_key, str)
-                if glibc_key.endswith("-nsw"):
-                    glibc_readiness_ver["keys"].remove(
-                        glibc_key,  # type: ignore[arg-type]
-                    )
-                    glibc_readiness_ver.pop(glibc_key)
-
-    for key in list(python_version_non_eol["keys"]):
-        assert isinstance(key, str)
-        if not key.endswith("-nsw"):
-            continue
-        if all(value == 0.0 for value in python_version_non_eol[key]):
-            python_version_non_eol["keys"].remove(key)  # type: ignore[arg-type]
-            python_version_non_eol.pop(key)
+    python_nsw_zeros = {
+        key
+        for key, zeros in zip(python_keys, (python_matrix == 0.0).all(axis=0), strict=True)
+        if key.endswith("-nsw") and zeros
+    }
+    python_nsw_zeros_non_eol = {
+        key
+        for key, zeros in zip(
+            python_keys_non_eol,
+            (python_matrix_non_eol == 0.0).all(axis=0),
+            strict=True,
+        )
+        if key.endswith("-nsw") and zeros
+    }
 
-    out["python_version"] = python_version
-    out["python_version_non_eol"] = python_version_non_eol
+    glibc_readiness = {}
+    for version in PYTHON_EOL:
+        readiness_keys = glibc_keys
+        if f"{version}-nsw" in python_nsw_zeros:
+            readiness_keys = [key for key in glibc_keys if not key.endswith("-nsw")]
+        glibc_readiness[version] = _get_stats_series(
+            readiness_keys,
+            _get_stats_matrix(
+                df[df["python_version"] == version],
+                "glibc_version",
+                index,
+                readiness_keys,
+                decimals=2,
+            ),
+        )
+
+    out["python_version"] = _get_stats_series(
+        [key for key in python_keys if key not in python_nsw_zeros],
+        python_matrix[:, [key not in python_nsw_zeros for key in python_keys]],
+    )
+    out["python_version_non_eol"] = _get_stats_series(
+        [key for key in python_keys_non_eol if key not in python_nsw_zeros_non_eol],
+        python_matrix_non_eol[
+            :,
+            [key not in python_nsw_zeros_non_eol for key in python_keys_non_eol],
+        ],
+    )
     out["glibc_readiness"] = glibc_readiness
 
     with utils.CONSUMER_DATA_PATH.open("w") as f:
         json.dump(out, f, separators=(",", ":"))
+
+    _prune_day_caches(start - utils.CONSUMER_WINDOW_SIZE)
@@ -1,39 +1,108 @@
-import json
+import functools
 import logging
+import multiprocessing
+import multiprocessing.pool
 import re
+import sys
 from datetime import date
-from typing import Any, Final
+from typing import Any, Final, NamedTuple
 
 from packaging.specifiers import InvalidSpecifier, SpecifierSet
 from packaging.version import InvalidVersion, Version
 
+import release_store
 import utils
 
 _LOGGER = logging.getLogger(__name__)
 _FREE_THREADED_ABI: Final[re.Pattern[str]] = re.compile(r"cp3(1[3-9]|[2-9][0-9])t")
+_BATCH_SIZE: Final[int] = 256
+# bump when rows computed from the same release info change
+DATASET_CACHE_VERSION: Final[int] = 1
+# bump when releases parsed from the same files change, stored records are then fetched
+# again, caches derived from them are keyed by etag & include it in their schema
+RELEASE_RECORD_VERSION: Final[int] = 1
+_DATASET_CACHE_SCHEMA: Final[list[int]] = [DATASET_CACHE_VERSION, RELEASE_RECORD_VERSION]
 
 
-def _filter_versions(package: str, info: dict[str, Any]) -> list[str]:
-    candidate_versions = []
-    for version in info["releases"]:
+class RequiresPython(NamedTuple):
+    specifier: SpecifierSet | None
+    # lowest python 3 minor matching the specifier, 2 when there's no valid specifier
+    minor: int | None
+
+
+@functools.lru_cache(maxsize=16384)
+def resolve_requires_python(requires_python: str) -> RequiresPython:
+    fixup_requires_python = requires_python
+    if fixup_requires_python in {"==3.10.4", "==3.10.5"}:
+        fixup_requires_python = "==3.10"
+    fixup_requires_python = fixup_requires_python.replace(".*", "")
+    fixup_requires_python = fixup_requires_python.replace("*", "")
+    fixup_requires_python = fixup_requires_python.replace('"', "")
+    fixup_requires_python = fixup_requires_python.replace("0<", "0,<")
+    fixup_requires_python = fixup_requires_python.replace("3<", "3,<")
+    try:
+        specifier = SpecifierSet(fixup_requires_python)
+    except InvalidSpecifier:
+        return RequiresPython(None, 2)
+    minor = next((minor for minor in range(2, 99) if f"3.{minor}" in specifier), None)
+    return RequiresPython(specifier, minor)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_python_tags(implementation: str) -> tuple[tuple[str, bool], ...]:
+    # normalized python tags along with whether their version is numeric
+    result = []
+    for python_ in implementation.replace(",", ".").split("."):
+        python = python_
+        if python.startswith("graalpy"):
+            python = f"gp{python[7:]}"
+        elif python.startswith("pyston"):
+            python = f"pt{python[6:]}"
         try:
-            version_pep = Version(version)
-            candidate_versions.append((version, version_pep))
-        except InvalidVersion as e:
-            _LOGGER.warning('"%s": %s', package, e)
+            int(python[2:])
+            numeric = True
+        except ValueError:
+            numeric = False
+        result.append((python, numeric))
+    return tuple(result)
+
+
+class Release(NamedTuple):
+    version: str
+    upload_date: date
+    python: str
+    manylinux: str
+    # None when the version is invalid
+    prerelease: bool | None
+
 
-    candidate_versions.sort(key=lambda x: x[1], reverse=True)
+# parsed releases of a package, shared by the dataset & the wheel support map
+_RELEASE_INDEX: Final[dict[str, tuple[str, list[Release]]]] = {}
+
+
+def log_cache_info() -> None:
+    for cached in (resolve_requires_python, parse_python_tags):
+        info = cached.cache_info()
+        _LOGGER.info(
+            "%s cache: %d hits, %d misses, %d entries",
+            cached.__name__,
+            info.hits,
+            info.misses,
+            info.currsize,
+        )
+
+
+def _filter_versions(releases: list[Release]) -> list[Release]:
     filtered = []
-    upload_date_previous_date = date.max.isoformat()
-    for version, _ in candidate_versions:
-        upload_date = date.max.isoformat()
-        for file in info["releases"][version]:
-            upload_date = min(upload_date, file["upload_time"])
+    upload_date_previous_date = date.max
+    for release in releases:
+        if release.prerelease is None:
+            continue
         # Keep at most one version per day and do not keep maintenance branch
         # i.e dates shall be in same order as versions
-        if upload_date < upload_date_previous_date:
-            upload_date_previous_date = upload_date
-            filtered.append(version)
+        if release.upload_date < upload_date_previous_date:
+            upload_date_previous_date = release.upload_date
+            filtered.append(release)
     return filtered
 
 
@@ -46,39 +115,22 @@ def parse_version(files: list[dict[str, str]]) -> tuple[date, str, str]:
         filename = file["filename"]
         if not filename.lower().endswith(".whl"):
             continue
-        parsed_filename = utils.WHEEL_INFO_RE.match(filename)
-        if parsed_filename is None:
+        metadata = utils.parse_wheel_filename(filename)
+        if metadata is None:
             continue
-        requires_python: SpecifierSet | None = None
+        requires_python = RequiresPython(None, 2)
         if file["requires_python"]:
-            fixup_requires_python = file["requires_python"]
-            if fixup_requires_python in {"==3.10.4", "==3.10.5"}:
-                fixup_requires_python = "==3.10"
-            fixup_requires_python = fixup_requires_python.replace(".*", "")
-            fixup_requires_python = fixup_requires_python.replace("*", "")
-            fixup_requires_python = fixup_requires_python.replace('"', "")
-            fixup_requires_python = fixup_requires_python.replace("0<", "0,<")
-            fixup_requires_python = fixup_requires_python.replace("3<", "3,<")
-            try:
-                requires_python = SpecifierSet(fixup_requires_python)
-            except InvalidSpecifier:
+            requires_python = resolve_requires_python(file["requires_python"])
+            if requires_python.specifier is None:
                 specifier_set = file["requires_python"]
                 _LOGGER.warning(
                     'invalid requires_python "%s" for wheel "%s"',
                     specifier_set,
                     filename,
                 )
-        metadata = utils.WheelMetadata(*parsed_filename.groups()[1:])
-        for python_ in metadata.implementation.replace(",", ".").split("."):
+        for python_, numeric in parse_python_tags(metadata.implementation):
             python = python_
-            if python.startswith("graalpy"):
-                python = f"gp{python[7:]}"
-            elif python.startswith("pyston"):
-                python = f"pt{python[6:]}"
-
-            try:
-                int(python[2:])
-            except ValueError:
+            if not numeric:
                 skip_warning = filename.startswith(
                     (
                         "pyswEOS-0",
@@ -133,14 +185,9 @@ def parse_version(files: list[dict[str, str]]) -> tuple[date, str, str]:
                     if not skip_warning:
                         _LOGGER.warning("unsupported abi %r for wheel %r", metadata.abi, filename)
                     continue
-                if requires_python is None:
-                    python = "py32"
+                if requires_python.minor is not None:
+                    python = f"py3{requires_python.minor}"
                 else:
-                    for minor in range(2, 99):
-                        if f"3.{minor}" in requires_python:
-                            python = f"py3{minor}"
-                            break
-                if python == "py3":
                     specifier_set = file["requires_python"]
                     if not filename.startswith(("kaldi_active_grammar-0", "pyswEOS-")):
                         _LOGGER.warning(
@@ -179,30 +226,206 @@ def parse_version(files: list[dict[str, str]]) -> tuple[date, str, str]:
     return date.fromisoformat(upload_date), python_str, manylinux_str
 
 
-def _package_update(package: str) -> list[utils.Row]:
-    cache_file = utils.get_release_cache_path(package)
-    if not cache_file.exists():
-        return []
-    with cache_file.open() as f:
-        info = json.load(f)
+def build_releases(
+    package: str,
+    files_by_version: dict[str, list[dict[str, str]]],
+) -> list[Release]:
+    # releases are sorted by decreasing version, invalid versions last
+    candidate_releases = []
+    invalid_releases = []
+    for version, files in files_by_version.items():
+        upload_date, python, manylinux = parse_version(files)
+        python, manylinux = sys.intern(python), sys.intern(manylinux)
+        try:
+            version_pep = Version(version)
+        except InvalidVersion as e:
+            _LOGGER.warning('"%s": %s', package, e)
+            invalid_releases.append(Release(version, upload_date, python, manylinux, None))
+            continue
+        release = Release(version, upload_date, python, manylinux, version_pep.is_prerelease)
+        candidate_releases.append((version_pep, release))
+    candidate_releases.sort(key=lambda x: x[0], reverse=True)
+    releases = [release for _, release in candidate_releases]
+    releases.extend(invalid_releases)
+    return releases
 
-    versions = _filter_versions(package, info)
+
+def dump_releases(etag: str, releases: list[Release]) -> dict[str, Any]:
+    return {
+        "etag": etag,
+        "schema": RELEASE_RECORD_VERSION,
+        "releases": [
+            (r.version, r.upload_date.isoformat(), r.python, r.manylinux, r.prerelease)
+            for r in releases
+        ],
+    }
+
+
+def _load_releases(info: dict[str, Any]) -> list[Release]:
+    return [
+        Release(version, date.fromisoformat(day), sys.intern(python), sys.intern(manylinux), pre)
+        for version, day, python, manylinux, pre in info["releases"]
+    ]
+
+
+def get_releases(package: str) -> list[Release] | None:
+    store = release_store.get_store()
+    etag = store.get_info_etag(package)
+    if etag is None:
+        return None
+    cached = _RELEASE_INDEX.get(package)
+    if cached is not None and cached[0] == etag:
+        return cached[1]
+    info = store.get_info(package)
+    if info is None:
+        return None
+    releases = _parse_info(package, info)
+    if releases is None:
+        return None
+    if info.get("schema") is None:
+        # files stored before release records, upgraded once
+        store.put_info(package, dump_releases(etag, releases))
+    _RELEASE_INDEX[package] = etag, releases
+    return releases
+
+
+def _parse_info(package: str, info: dict[str, Any]) -> list[Release] | None:
+    schema = info.get("schema")
+    if schema == RELEASE_RECORD_VERSION:
+        return _load_releases(info)
+    if schema is None:
+        return build_releases(package, info["releases"])
+    _LOGGER.warning('"%s": ignoring release records with schema %s', package, schema)
+    return None
+
+
+def _scan_releases(packages: set[str]) -> None:
+    # a single ordered scan of the store rather than lookups per package, upgrades are
+    # written once the scan is done
+    store = release_store.get_store()
+    upgraded = []
+    for package, etag, info in store.iter_infos(packages):
+        releases = _parse_info(package, info)
+        if releases is None:
+            continue
+        if info.get("schema") is None:
+            upgraded.append((package, dump_releases(etag, releases)))
+        _RELEASE_INDEX[package] = etag, releases
+    store.put_infos(upgraded)
+
+
+def _package_update(package: str) -> list[utils.Row] | None:
+    # releases are indexed beforehand
+    entry = _RELEASE_INDEX.get(package)
+    if entry is None:
+        return None
+    releases = entry[1]
+
+    filtered = _filter_versions(releases)
+    versions = [release.version for release in filtered]
     _LOGGER.debug('"%s": using "%s"', package, versions)
     rows = []
-    for version in versions:
-        week, python, manylinux = parse_version(info["releases"][version])
-        if python == "" or manylinux == "":
+    for release in filtered:
+        if release.python == "" or release.manylinux == "":
             continue
-        rows.append(utils.Row(week, package, version, python, manylinux))
-    if len(versions) and not rows:
+        rows.append(
+            utils.Row(
+                release.upload_date,
+                package,
+                release.version,
+                release.python,
+                release.manylinux,
+            ),
+        )
+    if versions and not rows:
         _LOGGER.warning('"%s": no manylinux wheel in "%s"', package, versions)
     return rows
 
 
-def update(packages: list[str]) -> tuple[list[str], list[utils.Row]]:
+def _index_releases(
+    packages: list[str],
+) -> list[tuple[str, tuple[str, list[Release]]]]:
+    return [
+        (package, _RELEASE_INDEX[package])
+        for package in packages
+        if get_releases(package) is not None
+    ]
+
+
+def _load_dataset_cache() -> dict[str, tuple[str, list[utils.Row]]]:
+    data = utils.load_json_cache(utils.DATASET_CACHE_PATH, _DATASET_CACHE_SCHEMA)
+    return {
+        package: (
+            etag,
+            [
+                utils.Row(date.fromisoformat(day), package, version, python, manylinux)
+                for day, version, python, manylinux in rows
+            ],
+        )
+        for package, (etag, rows) in data.items()
+    }
+
+
+def _save_dataset_cache(cache: dict[str, tuple[str, list[utils.Row]]]) -> None:
+    packages = {
+        package: (
+            etag,
+            [(row.day.isoformat(), row.version, row.python, row.manylinux) for row in rows],
+        )
+        for package, (etag, rows) in sorted(cache.items())
+    }
+    utils.save_json_cache(utils.DATASET_CACHE_PATH, _DATASET_CACHE_SCHEMA, packages)
+
+
+def update(packages: list[str], jobs: int = 1) -> tuple[list[str], list[utils.Row]]:
+    etag_cache = release_store.get_store().get_etags()
+    # rows of a package only depend on its cache entry, identified by its etag
+    dataset_cache = _load_dataset_cache()
+    etags = {package: etag_cache.get(package, ("", False))[0] for package in packages}
+    outdated = [
+        package
+        for package in packages
+        if not etags[package] or dataset_cache.get(package, ("",))[0] != etags[package]
+    ]
+    outdated_set = set(outdated)
+    for package in outdated:
+        _RELEASE_INDEX.pop(package, None)
+    if jobs > 1 and outdated:
+        # releases are parsed in parallel, rows are still built in order from the index
+        if sys._is_gil_enabled():  # noqa: SLF001
+            pool = multiprocessing.Pool(jobs)
+        else:
+            pool = multiprocessing.pool.ThreadPool(jobs)
+        batches = [outdated[i : i + _BATCH_SIZE] for i in range(0, len(outdated), _BATCH_SIZE)]
+        with pool:
+            for entries in pool.imap_unordered(_index_releases, batches):
+                _RELEASE_INDEX.update(entries)
+    elif outdated:
+        _scan_releases(outdated_set)
     rows = []
+    new_dataset_cache: dict[str, tuple[str, list[utils.Row]]] = {}
     for package in packages:
-        _LOGGER.info('"%s": begin dataset creation', package)
-        rows.extend(_package_update(package))
-        _LOGGER.debug('"%s": end dataset creation', package)
+        package_rows: list[utils.Row] | None
+        if package not in outdated_set:
+            package_rows = dataset_cache[package][1]
+            new_dataset_cache[package] = dataset_cache[package]
+        else:
+            _LOGGER.info('"%s": begin dataset creation', package)
+            package_rows = _package_update(package)
+            _LOGGER.debug('"%s": end dataset creation', package)
+            if package_rows is not None:
+                if etags[package]:
+                    new_dataset_cache[package] = (etags[package], package_rows)
+            elif package in dataset_cache:
+                # release records that can't be read (outdated schema) keep the rows of the
+                # previous run, under its etag so that they're built again once fetched
+                _LOGGER.warning('"%s": keeping the rows of unreadable release records', package)
+                package_rows = dataset_cache[package][1]
+                new_dataset_cache[package] = dataset_cache[package]
+            else:
+                package_rows = []
+        rows.extend(package_rows)
+    _LOGGER.info("rebuilt dataset for %d packages out of %d", len(outdated), len(packages))
+    _save_dataset_cache(new_dataset_cache)
+    log_cache_info()
     return sorted({r.package for r in rows}), rows
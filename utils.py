@@ -1,17 +1,28 @@
+import functools
 import json
+import logging
+import os
 import re
 from datetime import date, timedelta
 from pathlib import Path
-from typing import NamedTuple
+from typing import Any, NamedTuple
+
+_LOGGER = logging.getLogger(__name__)
 
 ROOT_PATH = Path(__file__).resolve().parent
 BUILD_PATH = ROOT_PATH / "build"
 PRODUCER_DATA_PATH = BUILD_PATH / "producer-data.json"
 CONSUMER_DATA_PATH = BUILD_PATH / "consumer-data.json"
 CACHE_PATH = ROOT_PATH / "cache"
-RELEASE_INFO_PATH = CACHE_PATH / "info"
+RELEASE_STORE_PATH = CACHE_PATH / "releases.sqlite"
+WHEEL_SUPPORT_MAP_PATH = CACHE_PATH / "wheel_support_map.json"
+DATASET_CACHE_PATH = CACHE_PATH / "dataset.json"
+CONSUMER_CACHE_PATH = CACHE_PATH / "consumer_data"
+CONSUMER_AGGREGATE_PATH = CACHE_PATH / "consumer_aggregates"
+CONSUMER_ROLLING_PATH = CACHE_PATH / "consumer_rolling.npz"
 PRODUCER_WINDOW_SIZE = timedelta(days=182)
 CONSUMER_WINDOW_SIZE = timedelta(days=28)
+PYPI_URL = "https://pypi.org"
 USER_AGENT = "manylinux-timeline/1.0 (https://github.com/mayeut/manylinux-timeline)"
 
 
@@ -39,8 +50,89 @@ class WheelMetadata(NamedTuple):
     platform: str
 
 
-def get_release_cache_path(package: str) -> Path:
-    return RELEASE_INFO_PATH / f"{package}.json"
+def _split_wheel_tags(filename: str, start: int, end: int) -> tuple[str, str, str] | None:
+    python_end = filename.find("-", start + 1)
+    if python_end == -1:
+        return None
+    abi_end = filename.find("-", python_end + 2)
+    if abi_end == -1 or abi_end > end - 2:
+        return None
+    return (
+        filename[start:python_end],
+        filename[python_end + 1 : abi_end],
+        filename[abi_end + 1 : end],
+    )
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_wheel_filename(filename: str) -> WheelMetadata | None:
+    # equivalent to WHEEL_INFO_RE, new lines are left to it as "." and "$" handle them
+    if "\n" in filename:
+        match = WHEEL_INFO_RE.match(filename)
+        return None if match is None else WheelMetadata(*match.groups()[1:])
+    if not filename.endswith(".whl"):
+        return None
+    parts = filename[:-4].split("-")
+    if all(parts):
+        if len(parts) == 5:
+            return WheelMetadata(parts[0], parts[1], None, parts[2], parts[3], parts[4])
+        if len(parts) == 6 and parts[2][0].isdecimal():
+            return WheelMetadata(*parts)
+    # lazy groups of the regex end at the first "-" that still leaves room for the
+    # remaining non-empty groups, that's always the first candidate
+    end = len(filename) - 4
+    name_end = filename.find("-", 1)
+    if name_end == -1:
+        return None
+    version_end = filename.find("-", name_end + 2)
+    if version_end == -1:
+        return None
+    start = version_end + 1
+    build_tag = None
+    tags = None
+    if filename[start : start + 1].isdecimal():
+        build_end = filename.find("-", start + 1)
+        if build_end != -1:
+            tags = _split_wheel_tags(filename, build_end + 1, end)
+            if tags is not None:
+                build_tag = filename[start:build_end]
+    if tags is None:
+        tags = _split_wheel_tags(filename, start, end)
+        if tags is None:
+            return None
+    name, version = filename[:name_end], filename[name_end + 1 : version_end]
+    return WheelMetadata(name, version, build_tag, *tags)
+
+
+def load_json_cache(path: Path, schema: Any) -> dict[str, Any]:
+    # the per package entries of a JSON cache, empty when missing, invalid or outdated
+    if not path.exists():
+        return {}
+    try:
+        data = json.loads(path.read_text())
+    except ValueError as e:
+        _LOGGER.warning("ignoring invalid cache %s: %s", path, e)
+        return {}
+    if not isinstance(data, dict) or data.get("schema") != schema:
+        return {}
+    packages = data.get("packages")
+    return packages if isinstance(packages, dict) else {}
+
+
+def save_json_cache(path: Path, schema: Any, packages: dict[str, Any]) -> None:
+    # a killed job must not leave a truncated cache, make the update atomic
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with temp_path.open("w") as f:
+        json.dump({"schema": schema, "packages": packages}, f)
+    temp_path.replace(path)
+
+
+def get_consumer_cache_path(date_: date) -> Path:
+    return CONSUMER_CACHE_PATH / date_.strftime("%Y") / date_.strftime("%m") / f"{date_:%d}.npz"
+
+
+def get_consumer_aggregate_path(date_: date) -> Path:
+    return CONSUMER_AGGREGATE_PATH / date_.strftime("%Y") / date_.strftime("%m") / f"{date_:%d}.npz"
 
 
 def load_removed_packages() -> dict[str, date]: